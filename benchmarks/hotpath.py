@@ -0,0 +1,210 @@
+import argparse
+import json
+import logging
+import platform
+import statistics
+import sys
+import timeit
+from datetime import datetime
+from pathlib import Path
+from typing import Callable, Dict, List
+
+import numpy as np
+import shapely
+
+from handlers import polygon_handler
+from handlers.gis_items import (
+    assign_jnet_type,
+    extract_sn_nema_from_barcode,
+    parse_gis_item,
+)
+from handlers.lms_requests import DeviceData
+from handlers.monday_handler import Coordinates, MondayClient, MondayItem
+
+BASELINE_PATH = Path(__file__).with_name("baseline.json")
+DEFAULT_THRESHOLD = 0.25
+# shapely/GEOS cases don't track the interpreter loop and are noisier on shared runners
+NATIVE_THRESHOLD = 0.6
+NATIVE_CASES = {"polygon_handler.get_gateway_id", "polygon_handler.get_gateway_ids[1000]"}
+# the cheapest cases run in ~300ns, where a few tens of ns of jitter is already a double-digit percentage
+MIN_DELTA_NS = 50
+
+GIS_PAYLOAD = {
+    "data": {
+        "sn_nema": "SN:10315004;TYPE:NEMA",
+        "ogc_fid": "1234",
+        "old_sn": "40212345",
+        "date": "2024-01-01T10:15:00+02:00",
+        "longitude": "34.8600",
+        "latitude": "32.0300",
+        "picture": "picture.jpg",
+        "note": "replaced head",
+        "type_switches": "grilanda",
+        "lamp_type": "LED",
+        "svg": "maintenance",
+    }
+}
+
+
+def _calibration():
+    total = 0
+    for index in range(1000):
+        total += index * index
+    return total
+
+
+_CALIBRATION_POLYGON = shapely.buffer(shapely.Point(0, 0), 1.0, quad_segs=32)
+_CALIBRATION_POINTS = shapely.points(np.random.default_rng(0).uniform(-1.5, 1.5, size=(1000, 2)))
+
+
+def _native_calibration():
+    return shapely.within(_CALIBRATION_POINTS, _CALIBRATION_POLYGON)
+
+
+def build_cases() -> Dict[str, Callable[[], object]]:
+    representative_points = shapely.point_on_surface(polygon_handler.registry.layers()["or_yehuda"].geometries)
+    lon, lat = shapely.get_x(representative_points[0]), shapely.get_y(representative_points[0])
+    batch_lons = list(shapely.get_x(representative_points)) * 200
+    batch_lats = list(shapely.get_y(representative_points)) * 200
+    device = DeviceData(pole="10315004", serial_number="10315004", latitude=lat, longitude=lon, id_gateway=14)
+    monday_client = MondayClient("benchmark")
+    monday_item = MondayItem(
+        sn_nema="10315004",
+        insertion_date=datetime(2024, 1, 1),
+        coordinates=Coordinates(long=lon, lat=lat),
+        notes="replaced head",
+        old_sn="40212345",
+        lamp_type="LED",
+        type_switch="grilanda",
+        webhook_response={"LMS result": "10315004 inserted to LMS", "Status": "Pass"},
+    )
+    return {
+        "extract_sn_nema_from_barcode": lambda: extract_sn_nema_from_barcode("SN:10315004;TYPE:NEMA"),
+        "assign_jnet_type": lambda: assign_jnet_type("40212345"),
+        "polygon_handler.get_gateway_id": lambda: polygon_handler.get_gateway_id(lon=lon, lat=lat),
+        "polygon_handler.get_gateway_ids[1000]": lambda: polygon_handler.get_gateway_ids(batch_lons, batch_lats),
+        "parse_gis_item": lambda: parse_gis_item(GIS_PAYLOAD),
+        "DeviceData.to_json": device.to_json,
+        "MondayClient.create_item_mutation": lambda: monday_client._create_item_mutation(1, "topics", monday_item),
+    }
+
+
+def measure(func: Callable[[], object], min_time: float = 0.5, repeat: int = 5) -> float:
+    timer = timeit.Timer(func)
+    number, _ = timer.autorange()
+    number = max(1, int(number * min_time / 0.2))
+    return min(timer.repeat(repeat=repeat, number=number)) / number * 1e9
+
+
+def run() -> dict:
+    logging.disable(logging.CRITICAL)
+    results = {name: round(measure(func), 1) for name, func in build_cases().items()}
+    return {
+        "calibration_ns": round(measure(_calibration), 1),
+        "native_calibration_ns": round(measure(_native_calibration), 1),
+        "python": platform.python_version(),
+        "machine": platform.machine(),
+        "results_ns": results,
+    }
+
+
+def merge(runs: List[dict]) -> dict:
+    # separate processes differ by more than the threshold on the cheapest cases (hash seeds, memory layout), so take
+    # the median of several interleaved runs rather than trusting any single one
+    merged = dict(runs[0], results_ns={})
+    for key in ("calibration_ns", "native_calibration_ns"):
+        merged[key] = statistics.median(run[key] for run in runs if key in run)
+    for name in runs[0]["results_ns"]:
+        merged["results_ns"][name] = statistics.median(
+            run["results_ns"][name] for run in runs if name in run["results_ns"]
+        )
+    return merged
+
+
+def load(paths: List[Path]) -> dict:
+    return merge([json.loads(path.read_text()) for path in paths])
+
+
+def compare(
+    current: dict,
+    baseline: dict,
+    threshold: float,
+    native_threshold: float = NATIVE_THRESHOLD,
+    min_delta_ns: float = MIN_DELTA_NS,
+    calibrate: bool = True,
+) -> bool:
+    if current["python"].rsplit(".", 1)[0] != baseline["python"].rsplit(".", 1)[0]:
+        print(f"warning: baseline recorded on Python {baseline['python']}, running on {current['python']}")
+    python_scale = native_scale = 1.0
+    if calibrate:
+        # scale the baseline by a calibration loop so a slower or faster machine does not look like a regression, the
+        # interpreter loop for pure-Python cases and a GEOS predicate for the shapely ones
+        python_scale = current["calibration_ns"] / baseline["calibration_ns"]
+        native_scale = current["native_calibration_ns"] / baseline.get(
+            "native_calibration_ns", current["native_calibration_ns"]
+        )
+    passed = True
+    print(f"{'case':40} {'baseline':>12} {'current':>12} {'change':>8}")
+    for name, current_ns in current["results_ns"].items():
+        baseline_ns = baseline["results_ns"].get(name)
+        if baseline_ns is None:
+            print(f"{name:40} {'-':>12} {current_ns:>10.0f}ns {'new':>8}")
+            continue
+        native = name in NATIVE_CASES
+        expected_ns = baseline_ns * (native_scale if native else python_scale)
+        change = current_ns / expected_ns - 1
+        regressed = change > (native_threshold if native else threshold) and current_ns - expected_ns > min_delta_ns
+        passed &= not regressed
+        flag = "  REGRESSION" if regressed else ""
+        print(f"{name:40} {expected_ns:>10.0f}ns {current_ns:>10.0f}ns {change:>+7.0%}{flag}")
+    return passed
+
+
+def main():
+    arg_parser = argparse.ArgumentParser(description="Microbenchmarks for the /giscloud hot-path functions")
+    arg_parser.add_argument("--check", action="store_true", help="fail when a case regresses past the threshold")
+    arg_parser.add_argument("--update-baseline", action="store_true", help=f"write the results to {BASELINE_PATH.name}")
+    arg_parser.add_argument("--output", type=Path, help="write the results to this file instead of comparing them")
+    arg_parser.add_argument(
+        "--baseline",
+        type=Path,
+        nargs="+",
+        help="results recorded on this machine, e.g. from the target branch, compared without calibration scaling",
+    )
+    arg_parser.add_argument("--current", type=Path, nargs="+", help="compare these results instead of running now")
+    arg_parser.add_argument("--threshold", type=float, default=DEFAULT_THRESHOLD, help="allowed slowdown, 0.25 = 25%%")
+    arg_parser.add_argument(
+        "--native-threshold",
+        type=float,
+        default=NATIVE_THRESHOLD,
+        help="allowed slowdown of the shapely cases",
+    )
+    arg_parser.add_argument(
+        "--min-delta-ns",
+        type=float,
+        default=MIN_DELTA_NS,
+        help="slowdowns smaller than this many ns are never reported as a regression",
+    )
+    args = arg_parser.parse_args()
+
+    current = load(args.current) if args.current else run()
+    if args.output:
+        args.output.write_text(json.dumps(current, indent=2) + "\n")
+        return
+    if args.update_baseline:
+        BASELINE_PATH.write_text(json.dumps(current, indent=2) + "\n")
+        print(f"baseline written to {BASELINE_PATH}")
+    if args.check or not args.update_baseline:
+        if args.baseline:
+            baseline = load(args.baseline)
+        else:
+            baseline = json.loads(BASELINE_PATH.read_text()) if BASELINE_PATH.exists() else current
+        passed = compare(
+            current, baseline, args.threshold, args.native_threshold, args.min_delta_ns, calibrate=not args.baseline
+        )
+        if args.check and not passed:
+            sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
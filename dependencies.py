@@ -1,8 +1,68 @@
+import hmac
 import os
+from functools import lru_cache
 
+from fastapi import Header, HTTPException
+
+from handlers.giscloud_handler import GisCloudHandler
+from handlers.idempotency import IdempotencyStore
+from handlers.job_queue import JobQueue
 from handlers.lms_requests import LMSRequest
+from handlers.profiler import SamplingProfiler
+
+
+@lru_cache(maxsize=None)
+def get_lms_request() -> LMSRequest:
+    return LMSRequest(os.getenv("LMS_API_BASEURL"))
+
+
+@lru_cache(maxsize=None)
+def get_gis_handler() -> GisCloudHandler:
+    return GisCloudHandler(
+        os.getenv("GIS_CLOUD_API_KEY"),
+        base_api_url=os.getenv("GIS_CLOUD_API_URL"),
+        pictures_base_api_url=os.getenv("GIS_CLOUD_PICTURES_URL"),
+    )
 
 
 async def load_lms_token():
-    lms_base_url = os.getenv("LMS_API_BASEURL")
-    return LMSRequest(lms_base_url)
+    return get_lms_request()
+
+
+# read once per process: the job workers are only started at startup when async mode is on, a request
+# must never see it enabled later and enqueue jobs that no worker runs
+@lru_cache(maxsize=None)
+def async_mode_enabled() -> bool:
+    return os.getenv("GISCLOUD_ASYNC_MODE", "").lower() in ("1", "true", "yes")
+
+
+@lru_cache(maxsize=None)
+def get_job_queue() -> JobQueue:
+    return JobQueue(os.getenv("GISCLOUD_QUEUE_PATH", "data/giscloud_jobs.sqlite3"))
+
+
+@lru_cache(maxsize=None)
+def get_picture_queue() -> JobQueue:
+    return JobQueue(os.getenv("MONDAY_PICTURE_QUEUE_PATH", "data/monday_pictures.sqlite3"))
+
+
+@lru_cache(maxsize=None)
+def get_idempotency_store() -> IdempotencyStore:
+    return IdempotencyStore(
+        max_entries=int(os.getenv("GISCLOUD_IDEMPOTENCY_MAX_ENTRIES", "10000")),
+        ttl=float(os.getenv("GISCLOUD_IDEMPOTENCY_TTL", str(24 * 3600))),
+        path=os.getenv("GISCLOUD_IDEMPOTENCY_PATH"),
+    )
+
+
+@lru_cache(maxsize=None)
+def get_profiler() -> SamplingProfiler:
+    return SamplingProfiler(interval=float(os.getenv("PROFILER_INTERVAL_MS", "5")) / 1000)
+
+
+async def verify_admin_token(x_admin_token: str = Header(None)):
+    admin_token = os.getenv("ADMIN_TOKEN")
+    if not admin_token:
+        raise HTTPException(status_code=404, detail="Not Found")
+    if not x_admin_token or not hmac.compare_digest(x_admin_token, admin_token):
+        raise HTTPException(status_code=403, detail="Invalid admin token")
@@ -0,0 +1,78 @@
+import re
+from dataclasses import dataclass
+from datetime import datetime
+from logging import getLogger
+from typing import Optional
+
+from dateutil import parser
+from fastapi import HTTPException
+
+from handlers.monday_handler import Coordinates
+
+# keeps the router's logger name, the log sampling rules are keyed on it
+logger = getLogger("giscloud")
+
+
+@dataclass
+class GisItem:
+    feature_id: int
+    sn_nema: str
+    datetime: datetime
+    coordinate: Coordinates
+    picture: str
+    note: str
+    old_sn: str
+    type_switches: str
+    lamp_type: str
+    reason: str
+    jnet_type: str
+
+
+def extract_sn_nema_from_barcode(barcode: Optional[str]) -> Optional[str]:
+    if barcode is not None:
+        regex_result = re.search(r"([1-9][0-9]*\d{6,8})", barcode)
+        return regex_result.group() if regex_result else barcode
+    return barcode
+
+
+def assign_jnet_type(regex_result: str) -> str:
+    if regex_result and regex_result.startswith("103"):
+        return "Jnet1"
+    elif regex_result and regex_result[:3] in ["402", "750", "220", "470", "200", "400", "120"]:
+        return "Jnet0"
+    else:
+        return "Unknown"
+
+
+def has_old_sn(gis_item: GisItem) -> bool:
+    return bool(gis_item.old_sn) and gis_item.old_sn != "None"
+
+
+def parse_gis_item(request_body: dict) -> GisItem:
+    if not isinstance(request_body, dict) or "data" not in request_body:
+        raise HTTPException(
+            status_code=400,
+            detail="Invalid request body",
+        )
+
+    logger.info("extracting gis item from request body", extra={"request_body": request_body})
+
+    data = request_body["data"]
+    sn_nema = extract_sn_nema_from_barcode(data["sn_nema"])
+
+    return GisItem(
+        jnet_type=assign_jnet_type(sn_nema),
+        feature_id=int(data["ogc_fid"]),
+        sn_nema=sn_nema,
+        old_sn=extract_sn_nema_from_barcode(data["old_sn"]),
+        datetime=parser.isoparse(data["date"]),
+        coordinate=Coordinates(
+            long=float(data["longitude"]),
+            lat=float(data["latitude"]),
+        ),
+        picture=data["picture"],
+        note=data["note"],
+        type_switches=data["type_switches"],
+        lamp_type=data["lamp_type"],
+        reason=data["svg"],
+    )
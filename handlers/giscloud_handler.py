@@ -1,26 +1,85 @@
+from typing import Iterator, Optional
 from urllib.parse import urljoin
 
 import requests
 
+from handlers.metrics import instrumented
+from handlers.outbound_policy import get_policy
+
+
+class IncompleteFeaturesError(Exception):
+    pass
+
 
 class GisCloudHandler:
     BASE_API_URL = "https://api.giscloud.com/"
     PICTURES_BASE_API_URL = "https://editor.giscloud.com/"
 
-    def __init__(self, api_key):
-        self._base_api_url = self.BASE_API_URL
-        self._pictures_base_api_url = self.PICTURES_BASE_API_URL
+    def __init__(self, api_key, base_api_url: str = None, pictures_base_api_url: str = None):
+        self._base_api_url = base_api_url or self.BASE_API_URL
+        self._pictures_base_api_url = pictures_base_api_url or self.PICTURES_BASE_API_URL
         self.api_key = api_key
+        self._http = requests.Session()
 
+    @instrumented("giscloud", "get_picture")
     def get_picture(self, layer_id, feature_id, file_name) -> bytes:
         get_picture_data_url = urljoin(
             self._pictures_base_api_url,
             f"/rest/1/layers/{layer_id}/features/{feature_id}/picture/{file_name}",
         )
 
-        return requests.get(
-            url=get_picture_data_url,
+        response = get_policy(get_picture_data_url).request(
+            self._http,
+            "GET",
+            get_picture_data_url,
             params={
                 "api_key": self.api_key,
             },
-        ).content
+        )
+        response.raise_for_status()
+        return response.content
+
+    @instrumented("giscloud", "get_features")
+    def get_features_page(
+        self,
+        layer_id,
+        page: int = 1,
+        per_page: int = 1000,
+        where: Optional[str] = None,
+        order_by: Optional[str] = None,
+    ) -> dict:
+        features_url = urljoin(self._base_api_url, f"/1/layers/{layer_id}/features.json")
+        params = {
+            "api_key": self.api_key,
+            "page": page,
+            "perpage": per_page,
+        }
+        if where:
+            params["where"] = where
+        if order_by:
+            params["order_by"] = order_by
+        response = get_policy(features_url).request(self._http, "GET", features_url, params=params)
+        response.raise_for_status()
+        return response.json()
+
+    def iter_features(
+        self,
+        layer_id,
+        where: Optional[str] = None,
+        order_by: Optional[str] = None,
+        per_page: int = 1000,
+    ) -> Iterator[dict]:
+        page = 1
+        fetched = 0
+        while True:
+            response = self.get_features_page(layer_id, page, per_page, where, order_by)
+            features = response.get("data") or []
+            fetched += len(features)
+            yield from features
+            if len(features) < per_page:
+                # rows added or removed between page requests shift the offsets, some features were never returned
+                total = response.get("total")
+                if total is not None and fetched < int(total):
+                    raise IncompleteFeaturesError(f"giscloud returned {fetched} of {total} features")
+                return
+            page += 1
@@ -0,0 +1,102 @@
+import hashlib
+import json
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+from logging import getLogger
+from pathlib import Path
+from typing import Any, Callable, Dict
+
+logger = getLogger(__name__)
+
+_MISSING = object()
+
+
+def hash_key(*parts) -> str:
+    return hashlib.sha256(json.dumps(parts, default=str, sort_keys=True).encode()).hexdigest()
+
+
+class IdempotencyStore:
+    def __init__(self, max_entries: int = 10_000, ttl: float = 24 * 3600, path=None):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self._entries: "OrderedDict[str, tuple]" = OrderedDict()
+        self._in_flight: Dict[str, threading.Event] = {}
+        self._lock = threading.Lock()
+        self._conn = None
+        if path:
+            Path(path).parent.mkdir(parents=True, exist_ok=True)
+            self._conn = sqlite3.connect(str(path), check_same_thread=False, isolation_level=None)
+            self._conn.execute(
+                "CREATE TABLE IF NOT EXISTS idempotency (key TEXT PRIMARY KEY, value TEXT NOT NULL, expires_at REAL)"
+            )
+            self._conn.execute("DELETE FROM idempotency WHERE expires_at < ?", (time.time(),))
+
+    def _get_locked(self, key: str):
+        entry = self._entries.get(key)
+        if entry is not None:
+            if entry[0] > time.time():
+                self._entries.move_to_end(key)
+                return entry[1]
+            del self._entries[key]
+        if self._conn is not None:
+            row = self._conn.execute(
+                "SELECT value, expires_at FROM idempotency WHERE key = ? AND expires_at > ?",
+                (key, time.time()),
+            ).fetchone()
+            if row is not None:
+                value = json.loads(row[0])
+                self._remember_locked(key, value, row[1])
+                return value
+        return _MISSING
+
+    def _remember_locked(self, key: str, value: Any, expires_at: float):
+        self._entries[key] = (expires_at, value)
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.max_entries:
+            self._entries.popitem(last=False)
+
+    def get(self, key: str, default=None):
+        with self._lock:
+            value = self._get_locked(key)
+        return default if value is _MISSING else value
+
+    def set(self, key: str, value: Any):
+        expires_at = time.time() + self.ttl
+        with self._lock:
+            self._remember_locked(key, value, expires_at)
+            if self._conn is not None:
+                self._conn.execute(
+                    "INSERT OR REPLACE INTO idempotency (key, value, expires_at) VALUES (?, ?, ?)",
+                    (key, json.dumps(value, default=str), expires_at),
+                )
+
+    def discard(self, key: str):
+        with self._lock:
+            self._entries.pop(key, None)
+            if self._conn is not None:
+                self._conn.execute("DELETE FROM idempotency WHERE key = ?", (key,))
+
+    def get_or_compute(self, key: str, compute: Callable[[], Any]) -> Any:
+        while True:
+            with self._lock:
+                value = self._get_locked(key)
+                if value is not _MISSING:
+                    logger.info("duplicate delivery served from the idempotency cache", extra={"key": key})
+                    return value
+                in_flight = self._in_flight.get(key)
+                if in_flight is None:
+                    in_flight = self._in_flight[key] = threading.Event()
+                    break
+            # the same delivery is already being processed, wait for it instead of repeating the upstream calls
+            in_flight.wait()
+
+        try:
+            value = compute()
+            self.set(key, value)
+            return value
+        finally:
+            with self._lock:
+                self._in_flight.pop(key, None)
+            in_flight.set()
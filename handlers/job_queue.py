@@ -0,0 +1,214 @@
+import json
+import sqlite3
+import threading
+import time
+import uuid
+from dataclasses import dataclass
+from logging import getLogger
+from pathlib import Path
+from typing import Any, Callable, Dict, List, Optional
+
+logger = getLogger(__name__)
+
+JOB_COLUMNS = "id, status, attempts, result, error, created_at, updated_at"
+
+
+@dataclass
+class Job:
+    id: str
+    payload: dict
+    attempts: int
+    idempotency_key: Optional[str] = None
+
+
+class JobQueue:
+    def __init__(self, path):
+        self.path = Path(path)
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        self._conn = sqlite3.connect(str(self.path), check_same_thread=False, isolation_level=None)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute("PRAGMA synchronous=FULL")
+        self._conn.execute(
+            """
+            CREATE TABLE IF NOT EXISTS jobs (
+                id TEXT PRIMARY KEY,
+                payload TEXT NOT NULL,
+                status TEXT NOT NULL,
+                attempts INTEGER NOT NULL DEFAULT 0,
+                result TEXT,
+                error TEXT,
+                created_at REAL NOT NULL,
+                updated_at REAL NOT NULL,
+                not_before REAL NOT NULL DEFAULT 0,
+                idempotency_key TEXT
+            )
+            """
+        )
+        columns = {row[1] for row in self._conn.execute("PRAGMA table_info(jobs)")}
+        if "not_before" not in columns:
+            self._conn.execute("ALTER TABLE jobs ADD COLUMN not_before REAL NOT NULL DEFAULT 0")
+        if "idempotency_key" not in columns:
+            self._conn.execute("ALTER TABLE jobs ADD COLUMN idempotency_key TEXT")
+        self._conn.execute("CREATE INDEX IF NOT EXISTS ix_jobs_status_created ON jobs (status, created_at)")
+        self._lock = threading.Lock()
+
+    def enqueue(self, payload: dict, idempotency_key: str = None) -> str:
+        job_id = uuid.uuid4().hex
+        now = time.time()
+        with self._lock:
+            self._conn.execute(
+                "INSERT INTO jobs (id, payload, status, created_at, updated_at, idempotency_key) "
+                "VALUES (?, ?, 'queued', ?, ?, ?)",
+                (job_id, json.dumps(payload), now, now, idempotency_key),
+            )
+        return job_id
+
+    def claim(self) -> Optional[Job]:
+        with self._lock:
+            self._conn.execute("BEGIN IMMEDIATE")
+            try:
+                row = self._conn.execute(
+                    "SELECT id, payload, attempts, idempotency_key FROM jobs "
+                    "WHERE status = 'queued' AND not_before <= ? ORDER BY created_at LIMIT 1",
+                    (time.time(),),
+                ).fetchone()
+                if row is None:
+                    self._conn.execute("COMMIT")
+                    return None
+                self._conn.execute(
+                    "UPDATE jobs SET status = 'running', attempts = attempts + 1, updated_at = ? WHERE id = ?",
+                    (time.time(), row[0]),
+                )
+                self._conn.execute("COMMIT")
+            except Exception:
+                self._conn.execute("ROLLBACK")
+                raise
+        return Job(id=row[0], payload=json.loads(row[1]), attempts=row[2] + 1, idempotency_key=row[3])
+
+    def complete(self, job_id: str, result: Any):
+        with self._lock:
+            self._conn.execute(
+                "UPDATE jobs SET status = 'done', result = ?, error = NULL, updated_at = ? WHERE id = ?",
+                (json.dumps(result, default=str), time.time(), job_id),
+            )
+
+    def fail(self, job_id: str, error: str, retry: bool = False, delay: float = 0.0):
+        now = time.time()
+        with self._lock:
+            self._conn.execute(
+                "UPDATE jobs SET status = ?, error = ?, updated_at = ?, not_before = ? WHERE id = ?",
+                ("queued" if retry else "failed", error, now, now + delay, job_id),
+            )
+
+    def requeue_running(self) -> int:
+        with self._lock:
+            cursor = self._conn.execute(
+                "UPDATE jobs SET status = 'queued', updated_at = ? WHERE status = 'running'",
+                (time.time(),),
+            )
+        return cursor.rowcount
+
+    def retry(self, job_id: str) -> bool:
+        with self._lock:
+            cursor = self._conn.execute(
+                "UPDATE jobs SET status = 'queued', attempts = 0, not_before = 0, updated_at = ? "
+                "WHERE id = ? AND status = 'failed'",
+                (time.time(), job_id),
+            )
+        return cursor.rowcount == 1
+
+    def get(self, job_id: str) -> Optional[dict]:
+        with self._lock:
+            row = self._conn.execute(f"SELECT {JOB_COLUMNS} FROM jobs WHERE id = ?", (job_id,)).fetchone()
+        return None if row is None else self._to_dict(row)
+
+    def list_jobs(self, status: str, limit: int = 100) -> List[dict]:
+        with self._lock:
+            rows = self._conn.execute(
+                f"SELECT {JOB_COLUMNS} FROM jobs WHERE status = ? ORDER BY created_at DESC LIMIT ?",
+                (status, limit),
+            ).fetchall()
+        return [self._to_dict(row) for row in rows]
+
+    def counts(self) -> Dict[str, int]:
+        with self._lock:
+            return dict(self._conn.execute("SELECT status, COUNT(*) FROM jobs GROUP BY status").fetchall())
+
+    @staticmethod
+    def _to_dict(row) -> dict:
+        return {
+            "id": row[0],
+            "status": row[1],
+            "attempts": row[2],
+            "result": json.loads(row[3]) if row[3] else None,
+            "error": row[4],
+            "created_at": row[5],
+            "updated_at": row[6],
+        }
+
+    def close(self):
+        with self._lock:
+            self._conn.close()
+
+
+class JobWorkerPool:
+    def __init__(
+        self,
+        queue: JobQueue,
+        handler: Callable[[dict], Any],
+        workers: int = 4,
+        poll_interval: float = 1.0,
+        max_attempts: int = 1,
+        retry_delay: float = 0.0,
+        name: str = "giscloud-worker",
+        on_failed: Callable[[Job], None] = None,
+    ):
+        self.queue = queue
+        self.handler = handler
+        self.workers = workers
+        self.poll_interval = poll_interval
+        self.max_attempts = max_attempts
+        self.retry_delay = retry_delay
+        self.name = name
+        self.on_failed = on_failed
+        self._wakeup = threading.Event()
+        self._stopping = threading.Event()
+        self._threads: List[threading.Thread] = []
+
+    def start(self):
+        requeued = self.queue.requeue_running()
+        if requeued:
+            logger.warning("requeued jobs interrupted by a previous shutdown", extra={"jobs": requeued})
+        for index in range(self.workers):
+            thread = threading.Thread(target=self._run, name=f"{self.name}-{index}", daemon=True)
+            thread.start()
+            self._threads.append(thread)
+
+    def notify(self):
+        self._wakeup.set()
+
+    def stop(self, timeout: float = 30.0):
+        self._stopping.set()
+        self._wakeup.set()
+        for thread in self._threads:
+            thread.join(timeout)
+        self._threads.clear()
+
+    def _run(self):
+        while not self._stopping.is_set():
+            job = self.queue.claim()
+            if job is None:
+                self._wakeup.wait(self.poll_interval)
+                self._wakeup.clear()
+                continue
+            try:
+                result = self.handler(job.payload)
+            except Exception as e:
+                logger.error("job failed", exc_info=True, extra={"job_id": job.id, "attempts": job.attempts})
+                retry = job.attempts < self.max_attempts
+                self.queue.fail(job.id, repr(e), retry=retry, delay=self.retry_delay)
+                if not retry and self.on_failed is not None:
+                    self.on_failed(job)
+            else:
+                self.queue.complete(job.id, result)
+                logger.info("job finished", extra={"job_id": job.id})
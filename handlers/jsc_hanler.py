@@ -1,15 +1,70 @@
 import json
+import os
+import threading
 import urllib
-from dataclasses import dataclass
+from dataclasses import dataclass, field
 from decimal import Decimal
+from functools import lru_cache
 from logging import getLogger
+from typing import Dict, Iterable, Iterator, List, Optional, Set, Tuple
 
 import pandas as pd
-from sqlalchemy import MetaData, Table, create_engine, inspect
+from sqlalchemy import MetaData, Table, bindparam, create_engine, inspect, text
+from sqlalchemy.engine import Engine
 from sqlalchemy.orm import Session
 
+from handlers.metrics import instrumented, observe
+
 logger = getLogger(__name__)
 
+SQL_SERVER_IN_CHUNK = 1000
+DB_POOL_SIZE = 5
+DB_MAX_OVERFLOW = 10
+DB_POOL_TIMEOUT = 30
+# Azure SQL drops idle connections after 30 minutes, recycle them before the gateway does
+DB_POOL_RECYCLE = 25 * 60
+# HOLDLOCK keeps the range locked between the match and the insert, two webhooks for one serial can't both insert
+MERGE_FIXTURES = """
+    MERGE dbo.tbl_fixtures WITH (HOLDLOCK) AS target
+    USING {source} AS source
+    ON target.name = source.name
+    WHEN MATCHED THEN
+        UPDATE SET
+            latitude = source.latitude,
+            longitude = source.longitude,
+            id_gateway = source.id_gateway,
+            ident = source.ident
+    WHEN NOT MATCHED THEN
+        INSERT (name, latitude, longitude, id_gateway, ident)
+        VALUES (source.name, source.latitude, source.longitude, source.id_gateway, source.ident)
+    OUTPUT {output};
+"""
+
+UPSERT_FIXTURE = text(
+    MERGE_FIXTURES.format(
+        source="(SELECT :name AS name, :latitude AS latitude, :longitude AS longitude, "
+        ":id_gateway AS id_gateway, :ident AS ident)",
+        output="inserted.id, $action",
+    )
+)
+
+STAGING_TABLE = "#tbl_fixtures_staging"
+# the staging table copies the column types of tbl_fixtures, it lives in the session so a pooled connection reuses it
+CREATE_STAGING_TABLE = text(
+    f"""
+    DROP TABLE IF EXISTS {STAGING_TABLE};
+    SELECT TOP 0 name, latitude, longitude, id_gateway, ident INTO {STAGING_TABLE} FROM dbo.tbl_fixtures;
+    """
+)
+INSERT_STAGING_TABLE = text(
+    f"""
+    INSERT INTO {STAGING_TABLE} (name, latitude, longitude, id_gateway, ident)
+    VALUES (:name, :latitude, :longitude, :id_gateway, :ident)
+    """
+)
+MERGE_STAGING_TABLE = text(MERGE_FIXTURES.format(source=STAGING_TABLE, output="inserted.name, $action"))
+DROP_STAGING_TABLE = text(f"DROP TABLE IF EXISTS {STAGING_TABLE}")
+
 
 class Fixture:
     def __init__(self, name, latitude, longitude, id_gateway=None, ident=None, **kwargs):
@@ -44,33 +99,87 @@ class ConnectionSettings:
     timeout: int = 30
 
 
+@dataclass
+class BulkUpsertResult:
+    inserted: Set[str] = field(default_factory=set)
+    updated: Set[str] = field(default_factory=set)
+    deleted: int = 0
+
+
+def construct_connection_string(conn_settings: ConnectionSettings) -> str:
+    conn_params = urllib.parse.quote_plus(
+        f"Driver={conn_settings.driver};"
+        f"Server=tcp:{conn_settings.server}.database.windows.net,1433;"
+        f"Database={conn_settings.database};"
+        f"Uid={conn_settings.username};"
+        f"Pwd={conn_settings.password};"
+        f"Encrypt=yes;"
+        f"TrustServerCertificate=no;"
+        f"Connection Timeout={conn_settings.timeout};"
+    )
+    return f"mssql+pyodbc:///?odbc_connect={conn_params}"
+
+
+_engines: Dict[Tuple[ConnectionSettings, bool], Engine] = {}
+_engines_lock = threading.Lock()
+
+
+def get_engine(conn_settings: ConnectionSettings, echo: bool = False) -> Engine:
+    engine = _engines.get((conn_settings, echo))
+    if engine is not None:
+        return engine
+    with _engines_lock:
+        if (conn_settings, echo) not in _engines:
+            _engines[(conn_settings, echo)] = create_engine(
+                construct_connection_string(conn_settings),
+                echo=echo,
+                fast_executemany=True,
+                pool_pre_ping=True,
+                pool_size=int(os.getenv("DB_POOL_SIZE", str(DB_POOL_SIZE))),
+                max_overflow=int(os.getenv("DB_MAX_OVERFLOW", str(DB_MAX_OVERFLOW))),
+                pool_timeout=float(os.getenv("DB_POOL_TIMEOUT", str(DB_POOL_TIMEOUT))),
+                pool_recycle=int(os.getenv("DB_POOL_RECYCLE", str(DB_POOL_RECYCLE))),
+            )
+        return _engines[(conn_settings, echo)]
+
+
+@lru_cache(maxsize=None)
+def get_fixtures_table(conn_settings: ConnectionSettings) -> Table:
+    with observe("azure_sql", "reflect"), get_engine(conn_settings).connect() as conn:
+        return Table("tbl_fixtures", MetaData(schema="dbo"), autoload_with=conn)
+
+
+def warm_up(conn_settings: ConnectionSettings):
+    try:
+        get_fixtures_table(conn_settings)
+    except Exception:
+        logger.warning("failed to warm up the JSC database connection pool", exc_info=True)
+
+
+def dispose_engines():
+    with _engines_lock:
+        for engine in _engines.values():
+            engine.dispose()
+        _engines.clear()
+
+
 class AzureDbConnection:
     def __init__(self, conn_settings: ConnectionSettings, echo: bool = False) -> None:
         self.conn_settings = conn_settings
         self.echo = echo
-        self.conn_string = self._construct_connection_string()
-        self.metadata = MetaData(schema="dbo")
-        self.engine = create_engine(self.conn_string, echo=self.echo, fast_executemany=True)
-        self.conn = self.engine.connect()
-        self.tbl_fixtures = Table("tbl_fixtures", self.metadata, autoload_with=self.conn)
+        self.conn_string = construct_connection_string(conn_settings)
+        # the engine and its pool live for the whole process, a connection only borrows one of its sockets
+        self.engine = get_engine(conn_settings, echo)
+        with observe("azure_sql", "connect"):
+            self.conn = self.engine.connect()
+        self.tbl_fixtures = get_fixtures_table(conn_settings)
+        self.metadata = self.tbl_fixtures.metadata
         self.session = Session(self.engine)
 
-    def _construct_connection_string(self) -> str:
-        conn_params = urllib.parse.quote_plus(
-            f"Driver={self.conn_settings.driver};"
-            f"Server=tcp:{self.conn_settings.server}.database.windows.net,1433;"
-            f"Database={self.conn_settings.database};"
-            f"Uid={self.conn_settings.username};"
-            f"Pwd={self.conn_settings.password};"
-            f"Encrypt=yes;"
-            f"TrustServerCertificate=no;"
-            f"Connection Timeout={self.conn_settings.timeout};"
-        )
-        return f"mssql+pyodbc:///?odbc_connect={conn_params}"
-
     def disconnect(self):
+        self.session.close()
+        # returns the connection to the pool, an uncommitted transaction is rolled back
         self.conn.close()
-        self.engine.dispose()
 
     def get_all_table_names(self):
         inspector = inspect(self.engine)
@@ -85,8 +194,10 @@ class AzureDbConnection:
     def insert_fixture(self, fixture: Fixture):
         fixture_dict = fixture.to_dict()
         try:
-            query = self.tbl_fixtures.insert().values(**fixture_dict).returning(self.tbl_fixtures.columns.id)
-            result = self.conn.execute(query)
+            # observed inside the try, the error is swallowed below and would never reach a decorator
+            with observe("azure_sql", "insert_fixture"):
+                query = self.tbl_fixtures.insert().values(**fixture_dict).returning(self.tbl_fixtures.columns.id)
+                result = self.conn.execute(query)
             logger.info("fixture was added successfully", extra={"fixture": fixture.name})
             return result.scalar()
         except Exception:
@@ -98,12 +209,15 @@ class AzureDbConnection:
                 query = self.tbl_fixtures.delete().where(self.tbl_fixtures.columns.name == fixture_name)
             else:
                 query = self.tbl_fixtures.delete().where(self.tbl_fixtures.columns.id == fixture_id)
+            with observe("azure_sql", "delete_fixture"):
+                result = self.conn.execute(query)
             logger.info("fixture was deleted successfully", extra={"fixture": fixture_name})
-            return self.conn.execute(query)
+            return result
         except Exception:
             logger.error("an error occurred", exc_info=True, extra={"fixture": fixture_name})
             return None
 
+    @instrumented("azure_sql", "update_fixture")
     def update_fixture(self, fixture: Fixture, fixture_name=None, fixture_id=None):
         fixture_dict = fixture.to_dict()
         if fixture_id is None:
@@ -114,12 +228,104 @@ class AzureDbConnection:
             query = self.tbl_fixtures.update().values(**fixture_dict).where(self.tbl_fixtures.columns.id == fixture_id)
         return self.conn.execute(query)
 
+    @instrumented("azure_sql", "upsert_fixture")
+    def upsert_fixture(self, fixture: Fixture) -> Tuple[int, bool]:
+        # until jobs/ensure_fixture_index.py has run a name may still have several rows, the MERGE updates them all
+        rows = self.conn.execute(UPSERT_FIXTURE, fixture.to_dict()).all()
+        if len(rows) > 1:
+            logger.warning(
+                "fixture name has duplicate rows",
+                extra={"fixture": fixture.name, "ids": [row[0] for row in rows]},
+            )
+        fixture_id, action = rows[0]
+        return fixture_id, action == "INSERT"
+
+    @instrumented("azure_sql", "bulk_upsert_fixtures")
+    def bulk_upsert_fixtures(
+        self,
+        fixtures: Iterable[Fixture],
+        deleted_names: Iterable[str] = (),
+        batch_size: int = 5000,
+    ) -> BulkUpsertResult:
+        # a MERGE source can't hold one name twice, the last fixture for a name wins
+        rows = list({fixture.name: fixture.to_dict() for fixture in fixtures}.values())
+        result = BulkUpsertResult()
+        if rows:
+            self.conn.execute(CREATE_STAGING_TABLE)
+            for chunk_start in range(0, len(rows), batch_size):
+                self.conn.execute(INSERT_STAGING_TABLE, rows[chunk_start : chunk_start + batch_size])
+            for name, action in self.conn.execute(MERGE_STAGING_TABLE):
+                (result.inserted if action == "INSERT" else result.updated).add(name)
+            self.conn.execute(DROP_STAGING_TABLE)
+        staged_names = result.inserted | result.updated
+        result.deleted = self.delete_fixtures(name for name in deleted_names if name not in staged_names)
+        return result
+
     def fixture_exists(self, fixture_name) -> bool:
         try:
             query = self.tbl_fixtures.select().where(self.tbl_fixtures.columns.name == fixture_name)
-            output = self.conn.execute(query)
-            results = output.fetchall()
+            with observe("azure_sql", "fixture_exists"):
+                results = self.conn.execute(query).fetchall()
             return len(results) != 0
         except Exception:
             logger.error("an error occurred", exc_info=True, extra={"fixture": fixture_name})
             return False
+
+    def _select_fixture_columns(self):
+        columns = self.tbl_fixtures.columns
+        return self.tbl_fixtures.select().with_only_columns(
+            columns.name,
+            columns.latitude,
+            columns.longitude,
+            columns.id_gateway,
+            columns.ident,
+        )
+
+    @instrumented("azure_sql", "get_fixtures")
+    def get_fixtures(self, fixture_names: Optional[Iterable[str]] = None) -> Dict[str, Fixture]:
+        columns = self.tbl_fixtures.columns
+        query = self._select_fixture_columns()
+        if fixture_names is None:
+            return {row.name: Fixture(**row._mapping) for row in self.conn.execute(query)}
+        fixture_names = list(dict.fromkeys(fixture_names))
+        fixtures = {}
+        for chunk_start in range(0, len(fixture_names), SQL_SERVER_IN_CHUNK):
+            chunk = fixture_names[chunk_start : chunk_start + SQL_SERVER_IN_CHUNK]
+            for row in self.conn.execute(query.where(columns.name.in_(chunk))):
+                fixtures[row.name] = Fixture(**row._mapping)
+        return fixtures
+
+    def iter_fixture_batches(self, batch_size: int = 5000) -> Iterator[List[Fixture]]:
+        result = self.conn.execution_options(yield_per=batch_size).execute(self._select_fixture_columns())
+        for rows in result.partitions():
+            yield [Fixture(**row._mapping) for row in rows]
+
+    @instrumented("azure_sql", "update_fixtures")
+    def update_fixtures(self, fixtures: List[Fixture]):
+        if not fixtures:
+            return
+        columns = self.tbl_fixtures.columns
+        query = (
+            self.tbl_fixtures.update()
+            .where(columns.name == bindparam("b_name"))
+            .values(
+                latitude=bindparam("b_latitude"),
+                longitude=bindparam("b_longitude"),
+                id_gateway=bindparam("b_id_gateway"),
+                ident=bindparam("b_ident"),
+            )
+        )
+        self.conn.execute(
+            query,
+            [{f"b_{key}": value for key, value in fixture.to_dict().items()} for fixture in fixtures],
+        )
+
+    @instrumented("azure_sql", "delete_fixtures")
+    def delete_fixtures(self, fixture_names: Iterable[str]) -> int:
+        fixture_names = list(dict.fromkeys(fixture_names))
+        deleted = 0
+        for chunk_start in range(0, len(fixture_names), SQL_SERVER_IN_CHUNK):
+            chunk = fixture_names[chunk_start : chunk_start + SQL_SERVER_IN_CHUNK]
+            result = self.conn.execute(self.tbl_fixtures.delete().where(self.tbl_fixtures.columns.name.in_(chunk)))
+            deleted += result.rowcount
+        return deleted
@@ -0,0 +1,118 @@
+import time
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from dataclasses import dataclass
+from logging import getLogger
+from typing import Any, Iterable, Iterator, List, Optional, Set, Tuple
+
+import requests
+
+from handlers.lms_requests import LMS_POOL_SIZE, LMSRequest, OpCodes
+from handlers.rate_limit import TokenBucket
+
+logger = getLogger(__name__)
+
+# group membership used to replace device commands is refreshed when older than this
+COMMAND_MEMBERSHIP_MAX_AGE = 60.0
+
+
+@dataclass
+class CommandResult:
+    target_type: str
+    target: str
+    opcode: int
+    response: Any = None
+    error: Optional[str] = None
+    elapsed: float = 0.0
+
+    @property
+    def ok(self) -> bool:
+        return self.error is None
+
+    def to_json(self):
+        return {
+            "targetType": self.target_type,
+            "target": self.target,
+            "opcode": self.opcode,
+            "response": self.response if isinstance(self.response, (dict, list, str)) else None,
+            "error": self.error,
+            "elapsed": self.elapsed,
+        }
+
+
+class CommandDispatcher:
+    def __init__(
+        self,
+        lms_request: LMSRequest,
+        max_concurrency: int = LMS_POOL_SIZE,
+        rate_per_second: float = None,
+        burst: float = None,
+        membership_max_age: float = COMMAND_MEMBERSHIP_MAX_AGE,
+    ):
+        self.lms_request = lms_request
+        self.max_concurrency = max_concurrency
+        # the LMS host policy already rate limits every call, a dispatcher only adds its own bucket to stay below it
+        self.rate_limiter = TokenBucket(rate_per_second, burst) if rate_per_second else None
+        self.membership_max_age = membership_max_age
+
+    def _fresh_members(self, group_id) -> Optional[Set[str]]:
+        inventory = self.lms_request.inventory
+        if inventory.age(group_id) > self.membership_max_age:
+            try:
+                inventory.refresh(group_id)
+            except Exception:
+                logger.warning("failed to refresh LMS group members", exc_info=True, extra={"group_id": group_id})
+                return None
+        return inventory.members(group_id)
+
+    def plan(self, serial_numbers: Iterable = (), group_ids: Iterable = ()) -> Tuple[List, List[str]]:
+        groups = list(dict.fromkeys(group_ids))
+        remaining = {str(serial_number) for serial_number in serial_numbers}
+        for group_id in groups:
+            # devices of an explicitly requested group already get the group command
+            remaining -= self._fresh_members(group_id) or set()
+        snapshot = self.lms_request.inventory.snapshot()
+        candidates = sorted(
+            (group_id for group_id, members in snapshot.items() if group_id not in groups and members),
+            key=lambda group_id: -len(snapshot[group_id]),
+        )
+        for group_id in candidates:
+            if not snapshot[group_id] <= remaining:
+                continue
+            # a group command only replaces device commands when every device in the group is a target, the
+            # snapshot may miss devices that joined the group since, so membership is confirmed first
+            members = self._fresh_members(group_id)
+            if members and members <= remaining:
+                groups.append(group_id)
+                remaining -= members
+        return groups, sorted(remaining)
+
+    def _send(self, target_type: str, target, opcode: int, op_codes: OpCodes) -> CommandResult:
+        if self.rate_limiter is not None:
+            self.rate_limiter.acquire()
+        result = CommandResult(target_type=target_type, target=str(target), opcode=opcode)
+        started_at = time.perf_counter()
+        try:
+            if target_type == "group":
+                result.response = self.lms_request.send_group_command(target, opcode, op_codes)
+            else:
+                result.response = self.lms_request.send_device_command(target, opcode, op_codes)
+        except requests.RequestException as e:
+            logger.error("LMS command failed", exc_info=True, extra={"target": target, "opcode": opcode})
+            result.error = str(e)
+        result.elapsed = time.perf_counter() - started_at
+        return result
+
+    def dispatch(
+        self,
+        opcode: int,
+        serial_numbers: Iterable = (),
+        group_ids: Iterable = (),
+        op_codes: OpCodes = None,
+    ) -> Iterator[CommandResult]:
+        groups, serials = self.plan(serial_numbers, group_ids)
+        logger.info("dispatching LMS command", extra={"opcode": opcode, "groups": groups, "devices": len(serials)})
+        targets = [("group", group_id) for group_id in groups] + [("device", serial) for serial in serials]
+        with ThreadPoolExecutor(max_workers=self.max_concurrency, thread_name_prefix="lms-command") as executor:
+            futures = [executor.submit(self._send, kind, target, opcode, op_codes) for kind, target in targets]
+            for future in as_completed(futures):
+                yield future.result()
@@ -0,0 +1,102 @@
+import json
+from concurrent.futures import ThreadPoolExecutor
+from datetime import date, timedelta
+from logging import getLogger
+from pathlib import Path
+from typing import Iterable, List, Tuple
+
+import pandas as pd
+
+from handlers.lms_requests import LMSRequest
+
+logger = getLogger(__name__)
+
+WINDOW_SIZES = {
+    "day": timedelta(days=1),
+    "week": timedelta(days=7),
+}
+
+
+def split_windows(start_date: date, end_date: date, window: str = "day") -> List[Tuple[date, date]]:
+    step = WINDOW_SIZES[window]
+    windows = []
+    window_start = start_date
+    while window_start <= end_date:
+        window_end = min(window_start + step - timedelta(days=1), end_date)
+        windows.append((window_start, window_end))
+        window_start = window_end + timedelta(days=1)
+    return windows
+
+
+def _records(response) -> list:
+    # POST /led/groups/consumption answers with a JSON array of consumption records
+    if not isinstance(response, list):
+        raise ValueError(f"unexpected LMS consumption payload: {type(response).__name__}")
+    invalid = [record for record in response if not isinstance(record, dict)]
+    if invalid:
+        raise ValueError(f"unexpected LMS consumption record: {invalid[0]!r}")
+    return response
+
+
+class ConsumptionExporter:
+    def __init__(
+        self,
+        lms_request: LMSRequest,
+        cache_dir: Path = None,
+        window: str = "day",
+        max_concurrency: int = 8,
+    ):
+        self.lms_request = lms_request
+        self.cache_dir = Path(cache_dir) if cache_dir else None
+        self.window = window
+        self.max_concurrency = max_concurrency
+        if self.cache_dir:
+            self.cache_dir.mkdir(parents=True, exist_ok=True)
+
+    def _cache_path(self, group_id, window_start: date, window_end: date) -> Path:
+        return self.cache_dir / f"{group_id}_{window_start.isoformat()}_{window_end.isoformat()}.json"
+
+    def _fetch_window(self, group_id, window_start: date, window_end: date) -> list:
+        # only windows that ended before today are final and safe to reuse
+        cacheable = self.cache_dir is not None and window_end < date.today()
+        if cacheable:
+            cache_path = self._cache_path(group_id, window_start, window_end)
+            if cache_path.exists():
+                return json.loads(cache_path.read_text())
+
+        records = _records(
+            self.lms_request.report_consumption(
+                start_date=window_start.isoformat(),
+                end_date=window_end.isoformat(),
+                id_groups=[group_id],
+            )
+        )
+        for record in records:
+            record.setdefault("idGroup", group_id)
+            record["windowStart"] = window_start.isoformat()
+            record["windowEnd"] = window_end.isoformat()
+
+        if cacheable:
+            cache_path.write_text(json.dumps(records))
+        return records
+
+    def export(
+        self,
+        start_date: date,
+        end_date: date,
+        group_ids: Iterable[int],
+        parquet_path: Path = None,
+    ) -> pd.DataFrame:
+        tasks = [
+            (group_id, window_start, window_end)
+            for group_id in group_ids
+            for window_start, window_end in split_windows(start_date, end_date, self.window)
+        ]
+        logger.info("exporting LMS consumption", extra={"windows": len(tasks), "window": self.window})
+        with ThreadPoolExecutor(max_workers=self.max_concurrency, thread_name_prefix="lms-consumption") as executor:
+            windows = list(executor.map(lambda task: self._fetch_window(*task), tasks))
+
+        consumption = pd.json_normalize([record for records in windows for record in records])
+        if parquet_path is not None:
+            consumption.to_parquet(parquet_path, index=False)
+        return consumption
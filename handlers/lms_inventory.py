@@ -0,0 +1,83 @@
+import threading
+import time
+from logging import getLogger
+from typing import Callable, Dict, Iterable, Optional, Set
+
+logger = getLogger(__name__)
+
+LMS_INVENTORY_TTL = 15 * 60
+
+
+def device_list(devices) -> list:
+    # GET /led/groups/{id}/devices answers with a JSON array of device objects
+    if not isinstance(devices, list) or not all(isinstance(device, dict) for device in devices):
+        raise ValueError(f"unexpected LMS device list payload: {type(devices).__name__}")
+    return devices
+
+
+class LMSDeviceInventory:
+    def __init__(self, fetch_devices: Callable[[int], object], ttl: float = LMS_INVENTORY_TTL):
+        self._fetch_devices = fetch_devices
+        self.ttl = ttl
+        self._serials: Dict[int, Set[str]] = {}
+        self._loaded_at: Dict[int, float] = {}
+        self._lock = threading.Lock()
+        self._refresh_lock = threading.Lock()
+
+    def warm(self, group_ids: Iterable[int]):
+        for group_id in group_ids:
+            try:
+                self.refresh(group_id)
+            except Exception:
+                logger.error("failed to warm LMS inventory", exc_info=True, extra={"group_id": group_id})
+
+    def refresh(self, group_id: int):
+        self.load(group_id, self._fetch_devices(group_id))
+
+    def load(self, group_id: int, devices):
+        serials = {str(device["serialNumber"]) for device in device_list(devices) if device.get("serialNumber")}
+        with self._lock:
+            self._serials[group_id] = serials
+            self._loaded_at[group_id] = time.monotonic()
+        logger.info("LMS inventory refreshed", extra={"group_id": group_id, "devices": len(serials)})
+
+    def is_tracked(self, group_id: int) -> bool:
+        return group_id in self._serials
+
+    def age(self, group_id: int) -> float:
+        return time.monotonic() - self._loaded_at.get(group_id, float("-inf"))
+
+    def is_stale(self, group_id: int) -> bool:
+        return self.age(group_id) > self.ttl
+
+    def contains(self, group_id: int, serial_number) -> Optional[bool]:
+        if not self.is_tracked(group_id):
+            return None
+        if self.is_stale(group_id) and self._refresh_lock.acquire(blocking=False):
+            # only one caller pays for the refresh, the others answer from the current snapshot
+            try:
+                self.refresh(group_id)
+            except Exception:
+                logger.warning("failed to refresh LMS inventory", exc_info=True, extra={"group_id": group_id})
+            finally:
+                self._refresh_lock.release()
+        with self._lock:
+            return str(serial_number) in self._serials[group_id]
+
+    def members(self, group_id: int) -> Set[str]:
+        with self._lock:
+            return set(self._serials.get(group_id, ()))
+
+    def snapshot(self) -> Dict[int, Set[str]]:
+        with self._lock:
+            return {group_id: set(serials) for group_id, serials in self._serials.items()}
+
+    def add(self, group_id: int, serial_number):
+        with self._lock:
+            if group_id in self._serials:
+                self._serials[group_id].add(str(serial_number))
+
+    def discard(self, group_id: int, serial_number):
+        with self._lock:
+            if group_id in self._serials:
+                self._serials[group_id].discard(str(serial_number))
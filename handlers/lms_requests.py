@@ -1,13 +1,58 @@
+import contextvars
 import os
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
 from dataclasses import dataclass
 from hashlib import md5
+from logging import getLogger
+from typing import Any, Dict, Iterable, Mapping, Optional
 
 import requests
 from dotenv import load_dotenv
 from pydantic import HttpUrl
+from requests.adapters import HTTPAdapter
+
+from handlers.lms_inventory import LMSDeviceInventory
+from handlers.metrics import instrumented
+from handlers.outbound_policy import PolicySettings, configure_upstream, get_policy
 
 load_dotenv()
 
+logger = getLogger(__name__)
+
+LMS_TIMEOUT = (5, 30)
+LMS_POOL_SIZE = 20
+# every LMS call, commands included, draws from this one host-wide token bucket. Onboarding a device is a create
+# plus a relay association, so 500 devices are ~1,000 calls: ~10 s at the default 100/s, with at most
+# LMS_POOL_SIZE calls in flight. At the generic 20/s upstream default the same onboarding took ~50 s.
+LMS_POLICY_SETTINGS = PolicySettings(
+    rate=float(os.getenv("LMS_RATE_LIMIT", "100")),
+    burst=float(os.getenv("LMS_RATE_BURST", "200")),
+    timeout=LMS_TIMEOUT,
+)
+LMS_SESSION_TTL = 20 * 60
+DUPLICATE_ENTRY = "duplicate entry, you can not insert records that already exist"
+
+# LMS answers a request made on an expired site session with 440 and this error code in the JSON body
+LMS_SESSION_EXPIRED_STATUS = 440
+LMS_SESSION_EXPIRED_ERROR = "session_expired"
+# a write rejected for an expired session is surfaced to the caller rather than sent a second time
+SESSION_REPLAY_METHODS = {"GET", "HEAD", "PUT"}
+
+_current_site = contextvars.ContextVar("lms_current_site", default=None)
+
+
+def _is_session_expired(response: requests.Response) -> bool:
+    if response.status_code != LMS_SESSION_EXPIRED_STATUS:
+        return False
+    try:
+        body = response.json()
+    except ValueError:
+        return False
+    return isinstance(body, dict) and str(body.get("error", "")).lower() == LMS_SESSION_EXPIRED_ERROR
+
 
 @dataclass
 class OpCodes:
@@ -113,20 +158,125 @@ class DeviceData:
         return self.idType
 
 
-class LMSRequest:
-    def __init__(self, base_url):
-        self.BASE_URL = base_url
-        self.token = self.get_access_token()
+@dataclass
+class UpsertResult:
+    serial_number: str
+    action: str = None
+    response: Any = None
+    group_response: Any = None
+    error: Optional[str] = None
+    group_error: Optional[str] = None
+
+    @property
+    def ok(self) -> bool:
+        return self.error is None
 
-    def get_access_token(self):
-        url = f"{self.BASE_URL}/token"
+    def to_json(self):
+        return {
+            "serialNumber": self.serial_number,
+            "action": self.action,
+            "response": self.response if isinstance(self.response, (dict, list, str)) else None,
+            "groupResponse": self.group_response if isinstance(self.group_response, (dict, list, str)) else None,
+            "error": self.error,
+            "groupError": self.group_error,
+        }
+
+
+class LMSTokenManager:
+    def __init__(self, base_url, refresh_margin: int = 60, default_ttl: int = 3600):
+        self.base_url = base_url
+        self.refresh_margin = refresh_margin
+        self.default_ttl = default_ttl
+        self._token = None
+        self._expires_at = 0.0
+        self._lock = threading.Lock()
+
+    def _is_fresh(self) -> bool:
+        return self._token is not None and time.monotonic() < self._expires_at - self.refresh_margin
+
+    def get_token(self) -> str:
+        if self._is_fresh():
+            return self._token
+        # single-flight: only the first caller logs in, the others wait and reuse its token
+        with self._lock:
+            if not self._is_fresh():
+                self._refresh()
+            return self._token
+
+    def invalidate(self, token: str = None):
+        with self._lock:
+            if token is None or token == self._token:
+                self._token = None
+                self._expires_at = 0.0
+
+    def _store(self, token_data: dict):
+        self._token = token_data["access_token"]
+        self._expires_at = time.monotonic() + int(token_data.get("expires_in", self.default_ttl))
+        logger.info("LMS access token refreshed", extra={"expires_in": token_data.get("expires_in")})
+
+    @instrumented("lms", "token")
+    def _refresh(self):
+        url = f"{self.base_url}/token"
         username = os.getenv("LMS_API_USERNAME")
         password = os.getenv("LMS_API_PASSWORD")
         hashed_password = md5(password.encode()).hexdigest()
         data = f"grant_type=password&username={username}&password={hashed_password}&client_id=ngAuthApp"
-        response = requests.post(url=url, data=data)
+        response = get_policy(url).request(
+            requests,
+            "POST",
+            url,
+            idempotent=True,
+            data=data,
+            timeout=LMS_TIMEOUT,
+        )
         response.raise_for_status()
-        return response.json()["access_token"]
+        self._store(response.json())
+
+
+_token_managers = {}
+_token_managers_lock = threading.Lock()
+
+
+def get_token_manager(base_url) -> LMSTokenManager:
+    with _token_managers_lock:
+        if base_url not in _token_managers:
+            _token_managers[base_url] = LMSTokenManager(base_url)
+        return _token_managers[base_url]
+
+
+class LMSRequest:
+    def __init__(self, base_url, token_manager: LMSTokenManager = None, timeout=LMS_TIMEOUT):
+        self.BASE_URL = base_url
+        if base_url:
+            configure_upstream(base_url, LMS_POLICY_SETTINGS)
+        self.token_manager = token_manager or get_token_manager(base_url)
+        self.timeout = timeout
+        self._http = requests.Session()
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=LMS_POOL_SIZE)
+        self._http.mount("http://", adapter)
+        self._http.mount("https://", adapter)
+        self.inventory = LMSDeviceInventory(self.get_all_devices)
+        self.session_ttl = LMS_SESSION_TTL
+        self._sessions: Dict[str, tuple] = {}
+        self._sessions_lock = threading.Lock()
+
+    @property
+    def token(self) -> str:
+        return self.token_manager.get_token()
+
+    def get_access_token(self):
+        return self.token_manager.get_token()
+
+    def _send(self, url: HttpUrl, method: str, token: str, json_data: dict = None):
+        headers = {"Authorization": f"Bearer {token}"}
+        return get_policy(url).request(
+            self._http,
+            method,
+            url,
+            headers=headers,
+            json=json_data or None,
+            timeout=self.timeout,
+        )
 
     def make_authenticated_request(
         self,
@@ -134,19 +284,64 @@ class LMSRequest:
         method: str,
         json_data: dict = None,
     ):
-        headers = {"Authorization": f"Bearer {self.token}"}
-        response = requests.request(
-            method=method,
-            url=url,
-            headers=headers,
-            json=json_data or None,
-        )
+        token = self.token
+        response = self._send(url, method, token, json_data)
+        if response.status_code == 401:
+            logger.info("LMS rejected the access token, re-authenticating", extra={"url": url})
+            self.token_manager.invalidate(token)
+            response = self._send(url, method, self.token, json_data)
+        site_name = _current_site.get()
+        if site_name and "/led/sites/" not in url and _is_session_expired(response):
+            logger.info("LMS site session expired, renewing", extra={"site_name": site_name, "url": url})
+            self.renew_session(site_name)
+            if method.upper() in SESSION_REPLAY_METHODS:
+                response = self._send(url, method, self.token, json_data)
         response.raise_for_status()
         try:
             return response.json()
         except ValueError:
             return response
 
+    def _session_is_valid(self, site_name: str, token: str) -> bool:
+        opened = self._sessions.get(site_name)
+        return opened is not None and opened[0] == token and time.monotonic() - opened[1] < self.session_ttl
+
+    def ensure_session(self, site_name: str):
+        token = self.token
+        if self._session_is_valid(site_name, token):
+            return
+        with self._sessions_lock:
+            if not self._session_is_valid(site_name, token):
+                self.session(site_name)
+                self._sessions[site_name] = (token, time.monotonic())
+                logger.info("LMS site session opened", extra={"site_name": site_name})
+
+    def renew_session(self, site_name: str):
+        with self._sessions_lock:
+            self._sessions.pop(site_name, None)
+        self.ensure_session(site_name)
+
+    @contextmanager
+    def site_session(self, site_name: str):
+        self.ensure_session(site_name)
+        reset_token = _current_site.set(site_name)
+        try:
+            yield self
+        finally:
+            _current_site.reset(reset_token)
+
+    def close(self):
+        with self._sessions_lock:
+            site_names = list(self._sessions)
+            self._sessions.clear()
+        for site_name in site_names:
+            try:
+                self.logout(site_name)
+                logger.info("LMS site session closed", extra={"site_name": site_name})
+            except requests.RequestException:
+                logger.warning("failed to log out of LMS site", exc_info=True, extra={"site_name": site_name})
+        self._http.close()
+
     def get_all_groups(self):
         url = f"{self.BASE_URL}/led/groups"
         return self.make_authenticated_request(url, "GET")
@@ -159,6 +354,7 @@ class LMSRequest:
         url = f"{self.BASE_URL}/led/sites"
         return self.make_authenticated_request(url, "GET")
 
+    @instrumented("lms", "session")
     def session(self, site_name: str = "Jerusalem - Israel"):
         url = f"{self.BASE_URL}/led/sites/{site_name}/session"
         return self.make_authenticated_request(url, "POST")
@@ -168,11 +364,9 @@ class LMSRequest:
         level: int = 100,
         sn: int = 10315004,
     ):
-        url = f"{self.BASE_URL}/led/devices/{sn}/commands/42"
-        json_data = OpCodes(arg1=level).to_json()
-
-        return self.make_authenticated_request(url, "POST", json_data)
+        return self.send_device_command(sn, 42, OpCodes(arg1=level))
 
+    @instrumented("lms", "logout")
     def logout(self, site_name: str = "Jerusalem - Israel"):
         url = f"{self.BASE_URL}/led/sites/{site_name}/logout"
         return self.make_authenticated_request(url, "POST")
@@ -216,7 +410,13 @@ class LMSRequest:
 
     def delete_group(self, group_id: int):
         url = f"{self.BASE_URL}/led/groups/{group_id}"
-        response = requests.delete(url, headers={"Authorization": f"Bearer {self.token}"})
+        response = get_policy(url).request(
+            self._http,
+            "DELETE",
+            url,
+            headers={"Authorization": f"Bearer {self.token}"},
+            timeout=self.timeout,
+        )
         if response.status_code == 200:
             return "Group deleted successfully."
         elif response.status_code == 400 and "could not be deleted. The group has devices associated." in response.text:
@@ -224,6 +424,7 @@ class LMSRequest:
         else:
             response.raise_for_status()
 
+    @instrumented("lms", "get_all_devices")
     def get_all_devices(self, group_id):
         url = f"{self.BASE_URL}/led/groups/{group_id}/devices"
         return self.make_authenticated_request(url, "GET")
@@ -233,30 +434,117 @@ class LMSRequest:
         response = self.make_authenticated_request(url, "GET")
         return response.json()
 
+    @instrumented("lms", "create_device")
     def create_device(self, group_id, device_data):
         url = f"{self.BASE_URL}/led/groups/{group_id}/devices"
-        return self.make_authenticated_request(
+        response = self.make_authenticated_request(
             url=url,
             method="POST",
             json_data=device_data,
         )
+        self.inventory.add(group_id, device_data["serialNumber"])
+        return response
 
+    @instrumented("lms", "update_device")
     def update_device(self, group_id, serial_number, device_data):
         url = f"{self.BASE_URL}/led/groups/{group_id}/devices/{serial_number}"
         return self.make_authenticated_request(url, "PUT", json_data=device_data)
 
+    def upsert_device(self, group_id, device: DeviceData, relay_group_id: int = None) -> UpsertResult:
+        serial_number = device.get_serial_number()
+        device_json = device.to_json()
+        result = UpsertResult(serial_number=serial_number)
+        try:
+            if self.inventory.contains(group_id, serial_number):
+                try:
+                    response = self.update_device(
+                        group_id=group_id,
+                        serial_number=serial_number,
+                        device_data=device_json,
+                    )
+                    result.action = "updated"
+                except requests.HTTPError as e:
+                    if e.response is None or e.response.status_code != 404:
+                        raise
+                    # the snapshot still lists a device that was deleted outside this process, create it instead
+                    logger.info("LMS device is gone, creating it", extra={"serial_number": serial_number})
+                    self.inventory.discard(group_id, serial_number)
+                    response = self.create_device(group_id=group_id, device_data=device_json)
+                    result.action = "created"
+            else:
+                response = self.create_device(group_id=group_id, device_data=device_json)
+                if response == DUPLICATE_ENTRY:
+                    response = self.update_device(
+                        group_id=group_id,
+                        serial_number=serial_number,
+                        device_data=device_json,
+                    )
+                    result.action = "updated"
+                else:
+                    result.action = "created"
+            result.response = response
+        except requests.RequestException as e:
+            logger.error("failed to upsert device", exc_info=True, extra={"serial_number": serial_number})
+            result.action = result.action or "failed"
+            result.error = str(e)
+            return result
+        if relay_group_id is not None:
+            # the device itself is stored at this point, a failed association is reported on its own
+            try:
+                if not self.inventory.contains(relay_group_id, serial_number):
+                    result.group_response = self.associate_device_to_group(
+                        group_id=relay_group_id,
+                        serial_number=serial_number,
+                    )
+            except requests.RequestException as e:
+                logger.error(
+                    "failed to associate device to relay group",
+                    exc_info=True,
+                    extra={"serial_number": serial_number, "group_id": relay_group_id},
+                )
+                result.group_error = str(e)
+        return result
+
+    def upsert_devices(
+        self,
+        group_id,
+        devices: Iterable[DeviceData],
+        relay_groups: Mapping[str, int] = None,
+        max_concurrency: int = LMS_POOL_SIZE,
+    ) -> Dict[str, UpsertResult]:
+        relay_groups = relay_groups or {}
+        with ThreadPoolExecutor(max_workers=max_concurrency, thread_name_prefix="lms-upsert") as executor:
+            futures = [
+                # each task runs in a copy of the caller's context, so it keeps the caller's site session
+                executor.submit(
+                    contextvars.copy_context().run,
+                    self.upsert_device,
+                    group_id,
+                    device,
+                    relay_groups.get(device.get_serial_number()),
+                )
+                for device in devices
+            ]
+            results = [future.result() for future in futures]
+        return {result.serial_number: result for result in results}
+
+    @instrumented("lms", "delete_device")
     def delete_device(self, group_id, serial_number):
         if serial_number == "":
             return "Serial number is empty."
         url = f"{self.BASE_URL}/led/groups/{group_id}/devices/{serial_number}"
         response = self.make_authenticated_request(url, "DELETE")
-        if response.ok:
+        if not isinstance(response, requests.Response) or response.ok:
+            self.inventory.discard(group_id, serial_number)
             return "Device deleted successfully."
         return "Device could not be deleted."
 
+    @instrumented("lms", "associate_device_to_group")
     def associate_device_to_group(self, group_id, serial_number, associate=0):
         url = f"{self.BASE_URL}/led/groups/{group_id}/devices/{serial_number}?associate={associate}"
-        return self.make_authenticated_request(url, "POST")
+        response = self.make_authenticated_request(url, "POST")
+        self.inventory.add(group_id, serial_number)
+        return response
 
     def get_all_types(self):
         return self._extracted_from_get_all_light_profiles_2("/led/type")
@@ -323,23 +611,19 @@ class LMSRequest:
     def get_command_by_id(self, id_command):
         return self._extracted_from_get_light_profile_2("/led/commands/", id_command)
 
-    def send_group_command(self, group_id, opcode, arg1=None):
-        return self._extracted_from_send_gateway_command_2("/led/groups/", group_id, opcode, arg1)
+    def send_group_command(self, group_id, opcode, op_codes: OpCodes = None):
+        return self._send_command("/led/groups/", group_id, opcode, op_codes)
 
-    def send_device_command(self, serial_number, opcode, arg1=None):
-        return self._extracted_from_send_gateway_command_2("/led/devices/", serial_number, opcode, arg1)
+    def send_device_command(self, serial_number, opcode, op_codes: OpCodes = None):
+        return self._send_command("/led/devices/", serial_number, opcode, op_codes)
 
-    def send_gateway_command(self, gateway_id, opcode, arg1=None):
-        return self._extracted_from_send_gateway_command_2("/led/gateways/", gateway_id, opcode, arg1)
+    def send_gateway_command(self, gateway_id, opcode, op_codes: OpCodes = None):
+        return self._send_command("/led/gateways/", gateway_id, opcode, op_codes)
 
-    # TODO Rename this here and in `send_group_command`, `send_device_command` and `send_gateway_command`
-    def _extracted_from_send_gateway_command_2(self, arg0, arg1, opcode):
-        url = f"{self.BASE_URL}{arg0}{arg1}/commands/{opcode}"
-        data = {}
-        if arg1 is not None:
-            data["arg1"] = arg1
-        response = self.make_authenticated_request(url, "POST", json=data)
-        return response.json()
+    @instrumented("lms", "command")
+    def _send_command(self, path, target, opcode, op_codes: OpCodes = None):
+        url = f"{self.BASE_URL}{path}{target}/commands/{opcode}"
+        return self.make_authenticated_request(url, "POST", json_data=(op_codes or OpCodes()).to_json())
 
     def create_light_profile(self, name, typeLP, events):
         url = f"{self.BASE_URL}/led/profiles"
@@ -406,9 +690,8 @@ class LMSRequest:
         response = self.make_authenticated_request(url, arg1, headers=headers)
         return response.json()
 
-    def report_consumption(self, base_url, start_date, end_date, id_groups):
-        url = f"{base_url}/led/groups/consumption"
-        headers = {"Authorization": f"Bearer {self.token}"}
+    @instrumented("lms", "report_consumption")
+    def report_consumption(self, start_date, end_date, id_groups):
+        url = f"{self.BASE_URL}/led/groups/consumption"
         data = {"startDate": start_date, "endDate": end_date, "idGroups": id_groups}
-        response = self.make_authenticated_request(url, "POST", json=data, headers=headers)
-        return response.json()
+        return self.make_authenticated_request(url, "POST", json_data=data)
@@ -0,0 +1,117 @@
+import contextvars
+import functools
+import threading
+import time
+from bisect import bisect_left
+from contextlib import contextmanager
+from typing import Dict, List, Optional, Tuple
+
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0)
+
+_request_timings: contextvars.ContextVar[Optional[List[Tuple[str, float]]]] = contextvars.ContextVar(
+    "request_timings",
+    default=None,
+)
+
+
+class Histogram:
+    def __init__(self, buckets=LATENCY_BUCKETS):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)
+        self.total = 0.0
+        self.count = 0
+
+    def observe(self, value: float):
+        self.counts[bisect_left(self.buckets, value)] += 1
+        self.total += value
+        self.count += 1
+
+
+class MetricsRegistry:
+    def __init__(self):
+        self._durations: Dict[Tuple[str, str], Histogram] = {}
+        self._errors: Dict[Tuple[str, str], int] = {}
+        self._lock = threading.Lock()
+
+    def observe(self, upstream: str, operation: str, seconds: float, failed: bool = False):
+        key = (upstream, operation)
+        with self._lock:
+            histogram = self._durations.get(key)
+            if histogram is None:
+                histogram = self._durations[key] = Histogram()
+            histogram.observe(seconds)
+            if failed:
+                self._errors[key] = self._errors.get(key, 0) + 1
+
+    def render(self) -> str:
+        lines = [
+            "# HELP synchronizer_stage_duration_seconds Latency of each sync pipeline stage.",
+            "# TYPE synchronizer_stage_duration_seconds histogram",
+        ]
+        with self._lock:
+            durations = {key: (list(h.counts), h.total, h.count, h.buckets) for key, h in self._durations.items()}
+            errors = dict(self._errors)
+        for (upstream, operation), (counts, total, count, buckets) in sorted(durations.items()):
+            labels = f'upstream="{upstream}",operation="{operation}"'
+            cumulative = 0
+            for bound, bucket_count in zip(buckets, counts):
+                cumulative += bucket_count
+                lines.append(f'synchronizer_stage_duration_seconds_bucket{{{labels},le="{bound}"}} {cumulative}')
+            lines.append(f'synchronizer_stage_duration_seconds_bucket{{{labels},le="+Inf"}} {count}')
+            lines.append(f"synchronizer_stage_duration_seconds_sum{{{labels}}} {total}")
+            lines.append(f"synchronizer_stage_duration_seconds_count{{{labels}}} {count}")
+        lines += [
+            "# HELP synchronizer_stage_errors_total Failed calls of each sync pipeline stage.",
+            "# TYPE synchronizer_stage_errors_total counter",
+        ]
+        for (upstream, operation), error_count in sorted(errors.items()):
+            labels = f'upstream="{upstream}",operation="{operation}"'
+            lines.append(f"synchronizer_stage_errors_total{{{labels}}} {error_count}")
+        return "\n".join(lines) + "\n"
+
+
+registry = MetricsRegistry()
+
+
+@contextmanager
+def observe(upstream: str, operation: str):
+    started_at = time.perf_counter()
+    failed = False
+    try:
+        yield
+    except BaseException:
+        failed = True
+        raise
+    finally:
+        elapsed = time.perf_counter() - started_at
+        registry.observe(upstream, operation, elapsed, failed)
+        timings = _request_timings.get()
+        if timings is not None:
+            timings.append((f"{upstream}-{operation}", elapsed))
+
+
+def instrumented(upstream: str, operation: str):
+    def decorator(func):
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            with observe(upstream, operation):
+                return func(*args, **kwargs)
+
+        return wrapper
+
+    return decorator
+
+
+def start_request_timings() -> contextvars.Token:
+    return _request_timings.set([])
+
+
+def finish_request_timings(token: contextvars.Token, total: float) -> str:
+    timings = _request_timings.get() or []
+    _request_timings.reset(token)
+    aggregated: Dict[str, List[float]] = {}
+    for name, elapsed in timings:
+        aggregated.setdefault(name, []).append(elapsed)
+    entries = [f"{name};dur={sum(values) * 1000:.1f}" for name, values in aggregated.items()]
+    entries.append(f"total;dur={total * 1000:.1f}")
+    return ", ".join(entries)
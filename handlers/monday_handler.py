@@ -1,9 +1,17 @@
 import json
+from dataclasses import dataclass
 from datetime import datetime
+from logging import getLogger
+from typing import List, Optional
 
 import requests
 from requests import Response
 
+from handlers.metrics import instrumented
+from handlers.outbound_policy import get_policy
+
+logger = getLogger(__name__)
+
 
 class Coordinates:
     def __init__(self, long: float, lat: float) -> None:
@@ -41,24 +49,40 @@ class MondayItem:
         self.webhook_response = webhook_response
 
 
+@dataclass
+class MondayItemResult:
+    item_id: Optional[str] = None
+    error: Optional[str] = None
+
+    @property
+    def ok(self) -> bool:
+        return self.error is None
+
+
 class MondayClient:
-    def __init__(self, api_key: str) -> None:
+    BASE_API_URL = "https://api.monday.com/v2"
+
+    def __init__(self, api_key: str, base_url: str = None) -> None:
         self.api_key = api_key
-        self._base_url = "https://api.monday.com/v2"
+        self._base_url = base_url or self.BASE_API_URL
         self._headers = {
             "Authorization": self.api_key,
         }
+        self._http = requests.Session()
 
     def _query(self, query):
-        return requests.post(
-            url=self._base_url,
+        response = get_policy(self._base_url).request(
+            self._http,
+            "POST",
+            self._base_url,
             headers=self._headers,
             json={
                 "query": query,
             },
-        ).json()
+        )
+        return response.json()
 
-    def add_item(
+    def _create_item_mutation(
         self,
         board_id: int,
         group_id: str,
@@ -67,8 +91,7 @@ class MondayClient:
         formatted_date = item.date.strftime("%Y-%m-%d")
         formatted_status = item.lamp_type or "לא ידוע"
         formatted_type_switch = item.type_switch or ""
-        payload = f"""
-        mutation {{
+        return f"""
             create_item(
                 board_id: {board_id},
                 group_id: "{group_id}",
@@ -78,11 +101,62 @@ class MondayClient:
             ) 
             {{
                 id
-            }}
+            }}"""
+
+    @instrumented("monday", "add_item")
+    def add_item(
+        self,
+        board_id: int,
+        group_id: str,
+        item: MondayItem,
+    ) -> str:
+        payload = f"""
+        mutation {{{self._create_item_mutation(board_id, group_id, item)}
         }}"""
 
         return self._query(query=payload)["data"]["create_item"]["id"]
 
+    @instrumented("monday", "add_items")
+    def add_items(
+        self,
+        board_id: int,
+        group_id: str,
+        items: List[MondayItem],
+        batch_size: int = 25,
+    ) -> List[MondayItemResult]:
+        results = []
+        for batch_start in range(0, len(items), batch_size):
+            batch = items[batch_start : batch_start + batch_size]
+            mutations = "".join(
+                f"\n            item_{index}: {self._create_item_mutation(board_id, group_id, item).lstrip()}"
+                for index, item in enumerate(batch)
+            )
+            payload = f"""
+        mutation {{{mutations}
+        }}"""
+            try:
+                response = self._query(query=payload)
+            except requests.RequestException as e:
+                logger.error("failed to create monday items", exc_info=True, extra={"items": len(batch)})
+                results.extend(MondayItemResult(error=str(e)) for _ in batch)
+                continue
+            data = response.get("data") or {}
+            # a failed mutation comes back as a null alias, its error names the alias in its path
+            errors = {}
+            for error in response.get("errors") or []:
+                path = error.get("path") or [None]
+                errors.setdefault(path[0], error.get("message", "unknown monday error"))
+            for index in range(len(batch)):
+                item_id = (data.get(f"item_{index}") or {}).get("id")
+                if item_id:
+                    results.append(MondayItemResult(item_id=item_id))
+                    continue
+                error = errors.get(f"item_{index}") or errors.get(None) or "monday did not return an item id"
+                logger.error("failed to create monday item", extra={"sn_nema": batch[index].sn, "error": error})
+                results.append(MondayItemResult(error=error))
+        return results
+
+    @instrumented("monday", "add_item_picture")
     def add_item_picture(
         self,
         item_id: str,
@@ -107,7 +181,9 @@ class MondayClient:
         headers = {
             "Authorization": self.api_key,
         }
-        return requests.post(
+        return get_policy(self._base_url).request(
+            self._http,
+            "POST",
             self._base_url,
             headers=headers,
             data=payload,
@@ -0,0 +1,166 @@
+import random
+import threading
+import time
+from dataclasses import dataclass
+from logging import getLogger
+from typing import Dict
+from urllib.parse import urlparse
+
+import requests
+
+from handlers.rate_limit import TokenBucket
+
+logger = getLogger(__name__)
+
+IDEMPOTENT_METHODS = {"GET", "HEAD", "OPTIONS", "PUT", "DELETE"}
+RETRYABLE_STATUS_CODES = {429, 502, 503, 504}
+THROTTLE_STATUS_CODES = {429, 503}
+
+
+class CircuitOpenError(requests.ConnectionError):
+    pass
+
+
+class CircuitBreaker:
+    def __init__(self, failure_threshold: int = 5, reset_timeout: float = 30.0):
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self._failures = 0
+        self._opened_at = None
+        self._half_open_probe = False
+        self._lock = threading.Lock()
+
+    @property
+    def state(self) -> str:
+        if self._opened_at is None:
+            return "closed"
+        if time.monotonic() - self._opened_at >= self.reset_timeout:
+            return "half_open"
+        return "open"
+
+    def allow(self) -> bool:
+        with self._lock:
+            state = self.state
+            if state == "closed":
+                return True
+            # after the reset timeout a single probe call decides whether the circuit closes again
+            if state == "half_open" and not self._half_open_probe:
+                self._half_open_probe = True
+                return True
+            return False
+
+    def record_success(self):
+        with self._lock:
+            self._failures = 0
+            self._opened_at = None
+            self._half_open_probe = False
+
+    def record_failure(self):
+        with self._lock:
+            self._failures += 1
+            if self._half_open_probe or self._failures >= self.failure_threshold:
+                self._opened_at = time.monotonic()
+            self._half_open_probe = False
+
+
+@dataclass(frozen=True)
+class RetryPolicy:
+    attempts: int = 3
+    base_delay: float = 0.2
+    max_delay: float = 5.0
+
+    def delay(self, attempt: int) -> float:
+        return random.uniform(0, min(self.max_delay, self.base_delay * 2**attempt))
+
+
+@dataclass(frozen=True)
+class PolicySettings:
+    rate: float = 20.0
+    burst: float = 40.0
+    min_rate: float = 1.0
+    timeout: tuple = (5, 30)
+    retry: RetryPolicy = RetryPolicy()
+    failure_threshold: int = 5
+    reset_timeout: float = 30.0
+
+
+class OutboundPolicy:
+    def __init__(self, host: str, settings: PolicySettings = PolicySettings()):
+        self.host = host
+        self.settings = settings
+        self.timeout = settings.timeout
+        self.retry = settings.retry
+        self.rate_limiter = TokenBucket(settings.rate, settings.burst)
+        self.breaker = CircuitBreaker(settings.failure_threshold, settings.reset_timeout)
+
+    def _adapt(self, status_code: int = None):
+        # AIMD: halve the rate when the upstream throttles us, creep back up while it answers normally
+        if status_code in THROTTLE_STATUS_CODES:
+            self.rate_limiter.rate = max(self.settings.min_rate, self.rate_limiter.rate / 2)
+            logger.warning("upstream is throttling", extra={"host": self.host, "rate": self.rate_limiter.rate})
+        elif self.rate_limiter.rate < self.settings.rate:
+            self.rate_limiter.rate = min(self.settings.rate, self.rate_limiter.rate + 0.5)
+
+    def _is_idempotent(self, method: str, idempotent: bool = None) -> bool:
+        return method.upper() in IDEMPOTENT_METHODS if idempotent is None else idempotent
+
+    def _check_circuit(self):
+        if not self.breaker.allow():
+            raise CircuitOpenError(f"circuit for {self.host} is open, failing fast")
+
+    def _record(self, status_code: int = None):
+        self._adapt(status_code)
+        if status_code is None or status_code >= 500:
+            self.breaker.record_failure()
+        else:
+            self.breaker.record_success()
+
+    def request(self, session, method: str, url: str, idempotent: bool = None, **kwargs) -> requests.Response:
+        kwargs.setdefault("timeout", self.timeout)
+        attempts = self.retry.attempts if self._is_idempotent(method, idempotent) else 1
+        for attempt in range(attempts):
+            self._check_circuit()
+            self.rate_limiter.acquire()
+            try:
+                response = session.request(method=method, url=url, **kwargs)
+            except (requests.ConnectionError, requests.Timeout):
+                self._record()
+                if attempt + 1 >= attempts:
+                    raise
+            except BaseException:
+                # any other failure still counts, and it must release a half-open probe or the circuit never closes
+                self._record()
+                raise
+            else:
+                self._record(response.status_code)
+                if response.status_code not in RETRYABLE_STATUS_CODES or attempt + 1 >= attempts:
+                    return response
+            logger.info("retrying upstream call", extra={"host": self.host, "url": url, "attempt": attempt + 1})
+            time.sleep(self.retry.delay(attempt))
+
+
+UPSTREAM_SETTINGS: Dict[str, PolicySettings] = {
+    "api.monday.com": PolicySettings(rate=5.0, burst=10.0),
+    "api.giscloud.com": PolicySettings(rate=10.0, burst=20.0),
+    "editor.giscloud.com": PolicySettings(rate=10.0, burst=20.0, timeout=(5, 60)),
+}
+
+_policies: Dict[str, OutboundPolicy] = {}
+_policies_lock = threading.Lock()
+
+
+def configure_upstream(url: str, settings: PolicySettings):
+    host = urlparse(url).netloc
+    with _policies_lock:
+        UPSTREAM_SETTINGS[host] = settings
+        policy = _policies.get(host)
+        if policy is not None and policy.settings != settings:
+            del _policies[host]
+
+
+def get_policy(url: str) -> OutboundPolicy:
+    host = urlparse(url).netloc
+    with _policies_lock:
+        if host not in _policies:
+            _policies[host] = OutboundPolicy(host, UPSTREAM_SETTINGS.get(host, PolicySettings()))
+        return _policies[host]
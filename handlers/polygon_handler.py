@@ -1,25 +1,284 @@
+import json
 import logging
+import os
+import threading
+import time
+from dataclasses import dataclass
 from pathlib import Path
+from typing import Dict, List, Optional, Sequence, Tuple
 
 import geopandas as gpd
-from shapely.geometry import Point
+import numpy as np
+import pyarrow.parquet as pq
+import shapely
+from pyproj import Transformer
+from shapely import STRtree
+
+from handlers.metrics import instrumented
 
 logger = logging.getLogger(__name__)
 
-gdf = gpd.read_file(Path("geo/or_yehuda.shp").resolve())
+GEO_CONFIG_DIR = "geo"
+GEO_CACHE_DIR = "data/geo_cache"
+RELOAD_CHECK_INTERVAL = 5.0
+GATEWAY_MAX_DISTANCE = 50.0
+
+
+def _source_mtime(path: Path) -> float:
+    # a shapefile is several sidecar files (.shp/.dbf/.shx/.prj), any of them changing invalidates the layer
+    return max((sibling.stat().st_mtime for sibling in path.parent.glob(f"{path.stem}.*")), default=0.0)
+
+
+@dataclass(frozen=True)
+class GatewayMatch:
+    gateway_id: Optional[str]
+    distance: float
+    layer: str
+
+
+def _utm_crs(lon: float, lat: float) -> str:
+    return f"EPSG:{(32600 if lat >= 0 else 32700) + int((lon + 180) // 6) % 60 + 1}"
+
+
+class PolygonLayer:
+    def __init__(self, name: str, config_path: Path, cache_dir: Path):
+        self.name = name
+        self.config_path = config_path
+        with open(config_path) as config_file:
+            config = json.load(config_file)
+        self.source_path = (config_path.parent / config["source"]).resolve()
+        self.id_column = config.get("id_column", "id")
+        self.gateways: Dict[str, str] = {str(key): value for key, value in config["gateways"].items()}
+        self.cache_path = cache_dir / f"{name}.parquet"
+        self.version = max(_source_mtime(self.source_path), config_path.stat().st_mtime)
+        self.polygon_ids, self.geometries = self._load_geometries()
+        self.gateway_ids_by_polygon = np.array(
+            [self.gateways.get(str(polygon_id)) for polygon_id in self.polygon_ids],
+            dtype=object,
+        )
+        self.index = STRtree(self.geometries)
+        min_lon, min_lat, max_lon, max_lat = shapely.total_bounds(self.geometries)
+        # nearest-gateway distances are measured in metres, in the UTM zone around the layer
+        self._to_metric = Transformer.from_crs(
+            "EPSG:4326",
+            _utm_crs((min_lon + max_lon) / 2, (min_lat + max_lat) / 2),
+            always_xy=True,
+        )
+        self.metric_index = STRtree(shapely.transform(self.geometries, self._project))
+
+    def _load_geometries(self):
+        if self.cache_path.exists() and self.cache_path.stat().st_mtime >= self.version:
+            try:
+                # the cache is always EPSG:4326, reading the WKB column directly skips geopandas' CRS parsing
+                table = pq.read_table(self.cache_path, columns=[self.id_column, "geometry"])
+                geometries = shapely.from_wkb(table.column("geometry").to_numpy(zero_copy_only=False))
+                return table.column(self.id_column).to_pylist(), geometries
+            except Exception:
+                logger.warning(
+                    "ignoring unreadable geometry cache",
+                    exc_info=True,
+                    extra={"path": str(self.cache_path)},
+                )
+        gdf = gpd.read_file(self.source_path)[[self.id_column, "geometry"]]
+        if gdf.crs is not None and not gdf.crs.equals("EPSG:4326"):
+            gdf = gdf.to_crs("EPSG:4326")
+        try:
+            self.cache_path.parent.mkdir(parents=True, exist_ok=True)
+            temporary_path = self.cache_path.with_suffix(f".{os.getpid()}.tmp")
+            gdf.to_parquet(temporary_path)
+            os.replace(temporary_path, self.cache_path)
+        except Exception:
+            logger.warning("failed to write geometry cache", exc_info=True, extra={"path": str(self.cache_path)})
+        logger.info("polygon layer parsed from source", extra={"layer": self.name, "polygons": len(gdf)})
+        return gdf[self.id_column].tolist(), gdf.geometry.values.to_numpy()
+
+    def is_outdated(self) -> bool:
+        try:
+            return max(_source_mtime(self.source_path), self.config_path.stat().st_mtime) > self.version
+        except FileNotFoundError:
+            return False
+
+    def query(self, points) -> np.ndarray:
+        point_matches, polygon_matches = self.index.query(points, predicate="within")
+        gateway_ids = np.full(len(points), None, dtype=object)
+        # a point on a shared border can fall in two polygons, the lowest polygon index wins like the row order did
+        order = np.lexsort((polygon_matches, point_matches))
+        point_matches, polygon_matches = point_matches[order], polygon_matches[order]
+        first_matches = np.unique(point_matches, return_index=True)[1]
+        gateway_ids[point_matches[first_matches]] = self.gateway_ids_by_polygon[polygon_matches[first_matches]]
+        return gateway_ids
+
+    def query_point(self, point) -> Optional[str]:
+        matches = self.index.query(point, predicate="within")
+        return self.gateway_ids_by_polygon[matches.min()] if len(matches) else None
+
+    def _project(self, coordinates: np.ndarray) -> np.ndarray:
+        return np.column_stack(self._to_metric.transform(coordinates[:, 0], coordinates[:, 1]))
+
+    def nearest(self, lons, lats, max_distance: float) -> Tuple[np.ndarray, np.ndarray]:
+        x, y = self._to_metric.transform(np.asarray(lons, dtype=float), np.asarray(lats, dtype=float))
+        points = shapely.points(x, y)
+        (point_matches, polygon_matches), match_distances = self.metric_index.query_nearest(
+            points,
+            max_distance=max_distance,
+            return_distance=True,
+            all_matches=False,
+        )
+        gateway_ids = np.full(len(points), None, dtype=object)
+        distances = np.full(len(points), np.inf)
+        gateway_ids[point_matches] = self.gateway_ids_by_polygon[polygon_matches]
+        distances[point_matches] = match_distances
+        return gateway_ids, distances
+
+    def nearest_point(self, lon, lat, max_distance: float) -> Tuple[Optional[str], float]:
+        x, y = self._to_metric.transform(lon, lat)
+        polygon_matches, distances = self.metric_index.query_nearest(
+            shapely.Point(x, y),
+            max_distance=max_distance,
+            return_distance=True,
+            all_matches=False,
+        )
+        if not len(polygon_matches):
+            return None, float("inf")
+        return self.gateway_ids_by_polygon[polygon_matches[0]], float(distances[0])
+
+
+class PolygonRegistry:
+    def __init__(self, config_dir, cache_dir, check_interval: float = RELOAD_CHECK_INTERVAL):
+        self.config_dir = Path(config_dir).resolve()
+        self.cache_dir = Path(cache_dir).resolve()
+        self.check_interval = check_interval
+        self._layers: Optional[Dict[str, PolygonLayer]] = None
+        self._checked_at = 0.0
+        self._lock = threading.Lock()
+
+    def load(self):
+        with self._lock:
+            self._reload_locked(self._layers or {})
+
+    def _reload_locked(self, current: Dict[str, PolygonLayer]):
+        layers = {}
+        for config_path in sorted(self.config_dir.glob("*.json")):
+            name = config_path.stem
+            layer = current.get(name)
+            if layer is not None and not layer.is_outdated():
+                layers[name] = layer
+                continue
+            try:
+                layers[name] = PolygonLayer(name, config_path, self.cache_dir)
+            except Exception:
+                logger.error("failed to load polygon layer", exc_info=True, extra={"layer": name})
+                if layer is not None:
+                    layers[name] = layer
+                continue
+            if layer is not None:
+                logger.info("polygon layer reloaded", extra={"layer": name})
+        # readers keep using the previous dict until this single reference swap
+        self._layers = layers
+        self._checked_at = time.monotonic()
+
+    def layers(self) -> Dict[str, PolygonLayer]:
+        layers = self._layers
+        if layers is not None and time.monotonic() - self._checked_at < self.check_interval:
+            return layers
+        with self._lock:
+            if self._layers is None or time.monotonic() - self._checked_at >= self.check_interval:
+                self._reload_locked(self._layers or {})
+            return self._layers
+
+    def _selected(self, layer: Optional[str]) -> Dict[str, PolygonLayer]:
+        layers = self.layers()
+        return {layer: layers[layer]} if layer else layers
+
+    def resolve_gateway(
+        self,
+        lon,
+        lat,
+        max_distance: float = GATEWAY_MAX_DISTANCE,
+        layer: str = None,
+    ) -> Optional[GatewayMatch]:
+        point = shapely.Point(lon, lat)
+        layers = self._selected(layer)
+        for name, polygon_layer in layers.items():
+            gateway_id = polygon_layer.query_point(point)
+            if gateway_id is not None:
+                return GatewayMatch(gateway_id=gateway_id, distance=0.0, layer=name)
+        nearest = None
+        if max_distance > 0:
+            for name, polygon_layer in layers.items():
+                gateway_id, distance = polygon_layer.nearest_point(lon, lat, max_distance)
+                if gateway_id is not None and (nearest is None or distance < nearest.distance):
+                    nearest = GatewayMatch(gateway_id=gateway_id, distance=distance, layer=name)
+        return nearest
+
+    def get_gateway_ids(
+        self,
+        lons: Sequence[float],
+        lats: Sequence[float],
+        max_distance: float = GATEWAY_MAX_DISTANCE,
+        layer: str = None,
+    ) -> List[Optional[str]]:
+        lons, lats = np.asarray(lons, dtype=float), np.asarray(lats, dtype=float)
+        points = shapely.points(lons, lats)
+        gateway_ids = np.full(len(points), None, dtype=object)
+        layers = self._selected(layer)
+        for polygon_layer in layers.values():
+            unresolved = np.flatnonzero(np.equal(gateway_ids, None))
+            if not len(unresolved):
+                break
+            gateway_ids[unresolved] = polygon_layer.query(points[unresolved])
+
+        unresolved = np.flatnonzero(np.equal(gateway_ids, None))
+        if max_distance > 0 and len(unresolved):
+            distances = np.full(len(unresolved), np.inf)
+            for polygon_layer in layers.values():
+                nearest_ids, nearest_distances = polygon_layer.nearest(lons[unresolved], lats[unresolved], max_distance)
+                closer = np.not_equal(nearest_ids, None) & (nearest_distances < distances)
+                gateway_ids[unresolved[closer]] = nearest_ids[closer]
+                distances[closer] = nearest_distances[closer]
+            fallbacks = int(np.count_nonzero(np.isfinite(distances)))
+            if fallbacks:
+                logger.warning(
+                    "points outside of all gateway polygons use the nearest gateway",
+                    extra={"points": fallbacks},
+                )
+        return gateway_ids.tolist()
+
+
+registry = PolygonRegistry(
+    os.getenv("GEO_CONFIG_DIR", GEO_CONFIG_DIR),
+    os.getenv("GEO_CACHE_DIR", GEO_CACHE_DIR),
+    check_interval=float(os.getenv("GEO_RELOAD_CHECK_INTERVAL", str(RELOAD_CHECK_INTERVAL))),
+)
+
+
+max_gateway_distance = float(os.getenv("GATEWAY_MAX_DISTANCE_METERS", str(GATEWAY_MAX_DISTANCE)))
+
+
+@instrumented("polygon", "resolve_gateway")
+def resolve_gateway(lon, lat, max_distance: float = None, layer: str = None) -> Optional[GatewayMatch]:
+    return registry.resolve_gateway(lon, lat, max_gateway_distance if max_distance is None else max_distance, layer)
+
 
-jnet_0_gw_id = {
-    "1": "0621.1003",
-    "2": "0621.1003",
-    "3": "0919.2002",
-    "4": "0919.2003",
-    "5": "0919.2000",
-}
+@instrumented("polygon", "get_gateway_id")
+def get_gateway_id(lon, lat, layer: str = None, max_distance: float = None) -> Optional[str]:
+    match = registry.resolve_gateway(lon, lat, max_gateway_distance if max_distance is None else max_distance, layer)
+    if match is None:
+        logger.warning("point is outside of all gateway polygons", extra={"lon": lon, "lat": lat})
+        return None
+    if match.distance:
+        logger.warning(
+            "point is outside of all gateway polygons, using the nearest gateway",
+            extra={"lon": lon, "lat": lat, "gateway_id": match.gateway_id, "distance": round(match.distance, 1)},
+        )
+    return match.gateway_id
 
 
-def get_gateway_id(lon, lat) -> str:
-    point = Point(lon, lat)  # ignore mypy error
-    logger.info("point", extra={"point": point})
-    gw_df = gdf.query("geometry.contains(@point)")
-    gw_index = gw_df["id"].values[0]
-    return jnet_0_gw_id[str(gw_index)]
+@instrumented("polygon", "get_gateway_ids")
+def get_gateway_ids(
+    lons: Sequence[float],
+    lats: Sequence[float],
+    layer: str = None,
+    max_distance: float = None,
+) -> List[Optional[str]]:
+    return registry.get_gateway_ids(lons, lats, max_gateway_distance if max_distance is None else max_distance, layer)
@@ -0,0 +1,189 @@
+import contextvars
+import html
+import random
+import re
+import sys
+import threading
+import time
+from collections import Counter
+from contextlib import contextmanager
+from pathlib import Path
+from typing import Optional
+
+APP_ROOT = Path(__file__).resolve().parent.parent
+
+_profiled_request: contextvars.ContextVar[bool] = contextvars.ContextVar("profiled_request", default=False)
+
+
+class SamplingProfiler:
+    def __init__(self, interval: float = 0.005, max_depth: int = 128):
+        self.interval = interval
+        self.max_depth = max_depth
+        self.enabled = False
+        self._rate = 0.0
+        self._remaining = 0
+        self._active = 0
+        self._sampled_requests = 0
+        self._samples = 0
+        self._stacks: Counter = Counter()
+        self._started_at: Optional[float] = None
+        self._stopped_at: Optional[float] = None
+        self._lock = threading.Lock()
+        self._wakeup = threading.Event()
+        self._thread: Optional[threading.Thread] = None
+        self._labels = {}
+        self._threads: Counter = Counter()
+
+    def start(self, rate: float = None, requests: int = None, interval: float = None):
+        if not rate and not requests:
+            raise ValueError("either a sampling rate or a number of requests is required")
+        with self._lock:
+            self._rate = rate or 0.0
+            self._remaining = requests or 0
+            if interval:
+                self.interval = interval
+            self._sampled_requests = 0
+            self._samples = 0
+            self._stacks = Counter()
+            self._started_at = time.time()
+            self._stopped_at = None
+            self.enabled = True
+
+    def stop(self):
+        with self._lock:
+            if self.enabled:
+                self._stopped_at = time.time()
+            self.enabled = False
+
+    def status(self) -> dict:
+        with self._lock:
+            return {
+                "enabled": self.enabled,
+                "rate": self._rate,
+                "remaining_requests": self._remaining,
+                "interval_ms": self.interval * 1000,
+                "sampled_requests": self._sampled_requests,
+                "active_requests": self._active,
+                "samples": self._samples,
+                "distinct_stacks": len(self._stacks),
+                "started_at": self._started_at,
+                "stopped_at": self._stopped_at,
+            }
+
+    def begin_request(self) -> Optional[contextvars.Token]:
+        # a plain attribute check, nothing else runs per request while profiling is off
+        if not self.enabled:
+            return None
+        with self._lock:
+            if not self.enabled:
+                return None
+            if self._remaining:
+                self._remaining -= 1
+                if not self._remaining and not self._rate:
+                    self.enabled = False
+                    self._stopped_at = time.time()
+            elif random.random() >= self._rate:
+                return None
+            self._active += 1
+            self._sampled_requests += 1
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._run, name="sampling-profiler", daemon=True)
+                self._thread.start()
+        self._wakeup.set()
+        return _profiled_request.set(True)
+
+    def end_request(self, token: contextvars.Token):
+        _profiled_request.reset(token)
+        with self._lock:
+            self._active -= 1
+
+    @contextmanager
+    def track_thread(self):
+        # only threads running work of a sampled request are profiled, the ones serving other requests are not
+        if not _profiled_request.get():
+            yield
+            return
+        ident = threading.get_ident()
+        with self._lock:
+            self._threads[ident] += 1
+        try:
+            yield
+        finally:
+            with self._lock:
+                self._threads[ident] -= 1
+                if not self._threads[ident]:
+                    del self._threads[ident]
+
+    def _run(self):
+        while True:
+            self._wakeup.wait()
+            self._wakeup.clear()
+            while self._active > 0:
+                self._sample()
+                time.sleep(self.interval)
+
+    def _label(self, code) -> str:
+        label = self._labels.get(code)
+        if label is None:
+            path = Path(code.co_filename)
+            try:
+                path = path.resolve().relative_to(APP_ROOT)
+            except ValueError:
+                path = Path(path.name)
+            label = self._labels[code] = f"{code.co_name} ({path}:{code.co_firstlineno})"
+        return label
+
+    def _sample(self):
+        with self._lock:
+            tracked = set(self._threads)
+        thread_names = {thread.ident: thread.name for thread in threading.enumerate()}
+        stacks = []
+        for ident, frame in sys._current_frames().items():
+            if ident not in tracked:
+                continue
+            codes = []
+            while frame is not None and len(codes) < self.max_depth:
+                codes.append(frame.f_code)
+                frame = frame.f_back
+            labels = [self._label(code) for code in reversed(codes)]
+            stacks.append(";".join([re.sub(r"[-_ ]?\d+$", "", thread_names.get(ident, str(ident))), *labels]))
+        with self._lock:
+            self._samples += 1
+            self._stacks.update(stacks)
+
+    def collapsed(self) -> str:
+        with self._lock:
+            stacks = sorted(self._stacks.items())
+        return "".join(f"{stack} {count}\n" for stack, count in stacks)
+
+    def html_report(self, top: int = 50) -> str:
+        with self._lock:
+            stacks = Counter(self._stacks)
+        status = self.status()
+        total = sum(stacks.values()) or 1
+        inclusive: Counter = Counter()
+        own: Counter = Counter()
+        for stack, count in stacks.items():
+            frames = stack.split(";")[1:]
+            for frame in set(frames):
+                inclusive[frame] += count
+            if frames:
+                own[frames[-1]] += count
+
+        def rows(counter: Counter) -> str:
+            return "".join(
+                f"<tr><td>{count}</td><td>{count * 100 / total:.1f}%</td><td>{html.escape(frame)}</td></tr>"
+                for frame, count in counter.most_common(top)
+            )
+
+        header = "<tr><th>samples</th><th>share</th><th>function</th></tr>"
+        return (
+            "<!DOCTYPE html><html><head><meta charset='utf-8'><title>synchronizer profile</title>"
+            "<style>body{font-family:monospace}td,th{padding:2px 8px;text-align:left}</style></head><body>"
+            f"<h1>synchronizer profile</h1><p>{status['sampled_requests']} sampled requests, "
+            f"{status['samples']} samples every {status['interval_ms']:.1f} ms, {total} thread stacks</p>"
+            f"<h2>inclusive</h2><table>{header}{rows(inclusive)}</table>"
+            f"<h2>self</h2><table>{header}{rows(own)}</table>"
+            f"<h2>collapsed stacks</h2><pre>{html.escape(self.collapsed())}</pre>"
+            "</body></html>"
+        )
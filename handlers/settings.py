@@ -0,0 +1,33 @@
+import os
+
+from dotenv import load_dotenv
+
+from handlers.jsc_hanler import ConnectionSettings
+
+load_dotenv()
+
+conn_settings = ConnectionSettings(
+    server=os.getenv("DB_HOST"),
+    database=os.getenv("DB_NAME"),
+    username=os.getenv("DB_USER"),
+    password=os.getenv("DB_PASSWORD"),
+)
+
+LMS_DEVICES_GROUP_ID = 259
+LMS_SITE_NAME = "Or Yehuda - Israel"
+
+LMS_GROUPS = {
+    "Illuminated flag": 286,
+    "grilanda": 284,
+    "Pedestrian sign": 282,
+    "tree switches": 280,
+    "Or Yehuda Garden Flood": 288,
+    "roundabout button": 283,
+    "Logo sign": 285,
+    "football switches": 346,
+    "24/7 sign": 372,
+    "V-led": 369,
+}
+
+JNET_1_GATEWAY_ID = 14
+JNET_0_GATEWAY_ID = 19
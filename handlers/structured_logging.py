@@ -0,0 +1,125 @@
+import copy
+import json
+import logging
+import queue
+import random
+import sys
+from datetime import datetime, timezone
+from logging.handlers import QueueHandler, QueueListener
+from typing import Dict, Optional
+
+DEFAULT_SAMPLE_RATES = {
+    "giscloud:fixture info": 0.1,
+    "giscloud:extracting gis item from request body": 0.1,
+}
+
+_RECORD_ATTRIBUTES = set(vars(logging.LogRecord("", 0, "", 0, "", None, None))) | {"message", "asctime"}
+_CONTAINER_TYPES = (dict, list, set)
+
+
+def parse_sample_rates(value: Optional[str]) -> Dict[str, float]:
+    if not value:
+        return dict(DEFAULT_SAMPLE_RATES)
+    rates = {}
+    for rule in value.split(","):
+        if rule.strip():
+            key, rate = rule.rsplit("=", 1)
+            rates[key.strip()] = float(rate)
+    return rates
+
+
+class JsonFormatter(logging.Formatter):
+    def format(self, record: logging.LogRecord) -> str:
+        entry = {
+            "timestamp": datetime.fromtimestamp(record.created, timezone.utc).isoformat(timespec="milliseconds"),
+            "level": record.levelname,
+            "logger": record.name,
+            "message": record.getMessage(),
+            "module": record.module,
+            "function": record.funcName,
+            "line": record.lineno,
+            "thread": record.threadName,
+        }
+        for key, value in record.__dict__.items():
+            if key not in _RECORD_ATTRIBUTES and not key.startswith("_"):
+                entry[key] = value
+        if record.exc_info and not record.exc_text:
+            record.exc_text = self.formatException(record.exc_info)
+        if record.exc_text:
+            entry["exception"] = record.exc_text
+        return json.dumps(entry, default=str, ensure_ascii=False)
+
+
+class DropOldestQueue(queue.Queue):
+    def __init__(self, maxsize: int):
+        super().__init__(maxsize)
+        self.dropped = 0
+
+    def put(self, item, block=True, timeout=None):
+        with self.not_full:
+            # never block the caller, make room by discarding the oldest buffered record
+            if 0 < self.maxsize <= self._qsize():
+                self._get()
+                self.dropped += 1
+                self.unfinished_tasks -= 1
+            self._put(item)
+            self.unfinished_tasks += 1
+            self.not_empty.notify()
+
+
+class SamplingFilter(logging.Filter):
+    def __init__(self, sample_rates: Dict[str, float]):
+        super().__init__()
+        self.sample_rates = sample_rates
+
+    def filter(self, record: logging.LogRecord) -> bool:
+        rate = self.sample_rates.get(f"{record.name}:{record.msg}", self.sample_rates.get(record.name))
+        return rate is None or random.random() < rate
+
+
+class NonBlockingQueueHandler(QueueHandler):
+    def prepare(self, record: logging.LogRecord) -> logging.LogRecord:
+        # only resolve what can't travel to the listener thread, the JSON formatting happens there
+        record = copy.copy(record)
+        record.msg = record.getMessage()
+        record.args = None
+        # the record copy is shallow, copy the top level of container extras so a caller that keeps filling its dict
+        # or list does not change the queued record. Nested values stay shared, callers must not mutate them after
+        # logging. Serializing is left to the listener, this runs on the caller's thread, often the event loop
+        for key, value in record.__dict__.items():
+            if isinstance(value, _CONTAINER_TYPES) and key not in _RECORD_ATTRIBUTES and not key.startswith("_"):
+                record.__dict__[key] = copy.copy(value)
+        if record.exc_info:
+            record.exc_text = logging.Formatter().formatException(record.exc_info)
+            record.exc_info = None
+        return record
+
+
+class StructuredLogging:
+    def __init__(
+        self,
+        level=logging.INFO,
+        buffer_size: int = 10_000,
+        sample_rates: Dict[str, float] = None,
+        stream=None,
+    ):
+        output_handler = logging.StreamHandler(stream or sys.stdout)
+        output_handler.setFormatter(JsonFormatter())
+        self.queue = DropOldestQueue(buffer_size)
+        self.handler = NonBlockingQueueHandler(self.queue)
+        self.handler.addFilter(SamplingFilter(DEFAULT_SAMPLE_RATES if sample_rates is None else sample_rates))
+        self.listener = QueueListener(self.queue, output_handler, respect_handler_level=True)
+        self.level = level
+
+    def start(self):
+        root_logger = logging.getLogger()
+        for handler in list(root_logger.handlers):
+            root_logger.removeHandler(handler)
+        root_logger.addHandler(self.handler)
+        root_logger.setLevel(self.level)
+        self.listener.start()
+
+    def stop(self):
+        if self.queue.dropped:
+            logging.getLogger(__name__).warning("log buffer overflowed", extra={"dropped": self.queue.dropped})
+        self.listener.stop()
@@ -0,0 +1,23 @@
+import json
+import threading
+import time
+from pathlib import Path
+
+
+class TrafficCapture:
+    def __init__(self, path=None):
+        self.path = Path(path) if path else None
+        self._lock = threading.Lock()
+        if self.path:
+            self.path.parent.mkdir(parents=True, exist_ok=True)
+
+    @property
+    def enabled(self) -> bool:
+        return self.path is not None
+
+    def record(self, request_body):
+        if not self.enabled:
+            return
+        line = json.dumps({"captured_at": time.time(), "body": request_body}, ensure_ascii=False)
+        with self._lock, self.path.open("a", encoding="utf-8") as capture_file:
+            capture_file.write(line + "\n")
@@ -0,0 +1,62 @@
+import argparse
+import json
+import logging
+import sys
+from logging import getLogger
+from typing import Dict
+
+from sqlalchemy import text
+
+from handlers.jsc_hanler import ConnectionSettings, get_engine
+from handlers.settings import conn_settings
+
+logger = getLogger(__name__)
+
+FIXTURE_NAME_INDEX = "ux_tbl_fixtures_name"
+
+FIXTURE_NAME_INDEX_EXISTS = text(
+    f"""
+    SELECT COUNT(*) FROM sys.indexes
+    WHERE name = '{FIXTURE_NAME_INDEX}' AND object_id = OBJECT_ID('dbo.tbl_fixtures')
+    """
+)
+DUPLICATE_FIXTURE_NAMES = text(
+    """
+    SELECT name, COUNT(*) AS fixture_rows FROM dbo.tbl_fixtures
+    GROUP BY name
+    HAVING COUNT(*) > 1
+    ORDER BY name
+    """
+)
+CREATE_FIXTURE_NAME_INDEX = text(f"CREATE UNIQUE INDEX {FIXTURE_NAME_INDEX} ON dbo.tbl_fixtures (name)")
+
+
+def ensure_fixture_name_index(conn_settings: ConnectionSettings, dry_run: bool = False) -> Dict[str, object]:
+    with get_engine(conn_settings).begin() as conn:
+        if conn.execute(FIXTURE_NAME_INDEX_EXISTS).scalar():
+            return {"index": FIXTURE_NAME_INDEX, "status": "exists"}
+        # CREATE UNIQUE INDEX fails on existing duplicates, list them so they can be merged by hand first
+        duplicates = {row.name: row.fixture_rows for row in conn.execute(DUPLICATE_FIXTURE_NAMES)}
+        if duplicates:
+            return {"index": FIXTURE_NAME_INDEX, "status": "duplicates", "duplicates": duplicates}
+        if dry_run:
+            return {"index": FIXTURE_NAME_INDEX, "status": "missing"}
+        conn.execute(CREATE_FIXTURE_NAME_INDEX)
+    logger.info("created the unique index on fixture names", extra={"index": FIXTURE_NAME_INDEX})
+    return {"index": FIXTURE_NAME_INDEX, "status": "created"}
+
+
+def main():
+    arg_parser = argparse.ArgumentParser(description="Create the unique index on JSC fixture names")
+    arg_parser.add_argument("--dry-run", action="store_true", help="check for duplicates without creating the index")
+    args = arg_parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO)
+    result = ensure_fixture_name_index(conn_settings, dry_run=args.dry_run)
+    print(json.dumps(result, indent=2))
+    if result["status"] == "duplicates":
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
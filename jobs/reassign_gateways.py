@@ -0,0 +1,143 @@
+import argparse
+import csv
+import json
+import logging
+import time
+from collections import Counter
+from dataclasses import asdict, dataclass, field
+from logging import getLogger
+from pathlib import Path
+from typing import Dict, List, Optional, Tuple
+
+from handlers import polygon_handler
+from handlers.jsc_hanler import AzureDbConnection, ConnectionSettings, Fixture
+from handlers.settings import conn_settings
+
+logger = getLogger(__name__)
+
+
+@dataclass
+class GatewayChange:
+    name: str
+    latitude: float
+    longitude: float
+    id_gateway: Optional[int]
+    old_ident: Optional[str]
+    new_ident: str
+
+    def to_fixture(self) -> Fixture:
+        return Fixture(
+            name=self.name,
+            latitude=self.latitude,
+            longitude=self.longitude,
+            id_gateway=self.id_gateway,
+            ident=self.new_ident,
+        )
+
+
+@dataclass
+class ReassignReport:
+    dry_run: bool
+    fixtures: int = 0
+    changed: int = 0
+    unresolved: int = 0
+    transitions: Dict[str, int] = field(default_factory=dict)
+    duration: float = 0.0
+
+
+def plan_gateway_changes(fixtures: List[Fixture], max_distance: float = None) -> Tuple[List[GatewayChange], int]:
+    gateway_ids = polygon_handler.get_gateway_ids(
+        lons=[float(fixture.longitude) for fixture in fixtures],
+        lats=[float(fixture.latitude) for fixture in fixtures],
+        max_distance=max_distance,
+    )
+    changes, unresolved = [], 0
+    for fixture, gateway_id in zip(fixtures, gateway_ids):
+        if gateway_id is None:
+            # keep the stored gateway rather than blanking it for a pole nowhere near a polygon
+            unresolved += 1
+        elif gateway_id != fixture.ident:
+            changes.append(
+                GatewayChange(
+                    name=fixture.name,
+                    latitude=fixture.latitude,
+                    longitude=fixture.longitude,
+                    id_gateway=fixture.id_gateway,
+                    old_ident=fixture.ident,
+                    new_ident=gateway_id,
+                )
+            )
+    return changes, unresolved
+
+
+def reassign_gateways(
+    conn_settings: ConnectionSettings,
+    dry_run: bool = False,
+    batch_size: int = 5000,
+    max_distance: float = None,
+    diff_path: Path = None,
+) -> ReassignReport:
+    started_at = time.perf_counter()
+    report = ReassignReport(dry_run=dry_run)
+    changes: List[GatewayChange] = []
+
+    db_conn = AzureDbConnection(conn_settings)
+    try:
+        for fixtures in db_conn.iter_fixture_batches(batch_size):
+            fixtures = [fixture for fixture in fixtures if None not in (fixture.latitude, fixture.longitude)]
+            batch_changes, unresolved = plan_gateway_changes(fixtures, max_distance)
+            report.fixtures += len(fixtures)
+            report.unresolved += unresolved
+            changes.extend(batch_changes)
+
+        report.changed = len(changes)
+        report.transitions = dict(Counter(f"{change.old_ident} -> {change.new_ident}" for change in changes))
+        if diff_path:
+            with open(diff_path, "w", newline="") as diff_file:
+                writer = csv.DictWriter(diff_file, fieldnames=list(GatewayChange.__dataclass_fields__))
+                writer.writeheader()
+                writer.writerows(asdict(change) for change in changes)
+
+        if changes and not dry_run:
+            # the stream is fully consumed before writing, the connection can't interleave both
+            for chunk_start in range(0, len(changes), batch_size):
+                chunk = changes[chunk_start : chunk_start + batch_size]
+                db_conn.update_fixtures([change.to_fixture() for change in chunk])
+            db_conn.conn.commit()
+    except Exception:
+        db_conn.conn.rollback()
+        raise
+    finally:
+        db_conn.disconnect()
+
+    report.duration = time.perf_counter() - started_at
+    logger.info("gateway reassignment finished", extra={"report": asdict(report)})
+    return report
+
+
+def main():
+    arg_parser = argparse.ArgumentParser(description="Recompute the gateway (ident) of every JSC fixture")
+    arg_parser.add_argument("--dry-run", action="store_true", help="report the changes without writing them")
+    arg_parser.add_argument("--diff", type=Path, help="write the changed rows to this CSV file")
+    arg_parser.add_argument("--batch-size", type=int, default=5000)
+    arg_parser.add_argument(
+        "--max-distance",
+        type=float,
+        default=None,
+        help="nearest-gateway cutoff in metres for poles outside every polygon, 0 disables the fallback",
+    )
+    args = arg_parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO)
+    report = reassign_gateways(
+        conn_settings,
+        dry_run=args.dry_run,
+        batch_size=args.batch_size,
+        max_distance=args.max_distance,
+        diff_path=args.diff,
+    )
+    print(json.dumps(asdict(report), indent=2))
+
+
+if __name__ == "__main__":
+    main()
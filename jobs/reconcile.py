@@ -0,0 +1,484 @@
+import argparse
+import json
+import logging
+import os
+import re
+import sqlite3
+import threading
+import time
+from dataclasses import asdict, dataclass, field
+from logging import getLogger
+from pathlib import Path
+from typing import Dict, Iterable, List, Optional
+
+from dependencies import get_gis_handler, get_lms_request
+from handlers import polygon_handler
+from handlers.gis_items import GisItem, has_old_sn, parse_gis_item
+from handlers.giscloud_handler import GisCloudHandler, IncompleteFeaturesError
+from handlers.idempotency import hash_key
+from handlers.jsc_hanler import AzureDbConnection, ConnectionSettings, Fixture
+from handlers.lms_inventory import device_list
+from handlers.lms_requests import DeviceData, LMSRequest
+from handlers.settings import (
+    JNET_0_GATEWAY_ID,
+    JNET_1_GATEWAY_ID,
+    LMS_DEVICES_GROUP_ID,
+    LMS_GROUPS,
+    LMS_SITE_NAME,
+    conn_settings,
+)
+
+logger = getLogger(__name__)
+
+GISCLOUD_WATERMARK = "giscloud"
+PRUNE_MAX_DELETES = 50
+PRUNE_MAX_RATIO = 0.05
+
+
+def _coordinate(value) -> Optional[float]:
+    return None if value is None else round(float(value), 7)
+
+
+def lms_fingerprint(serial_number, latitude, longitude, id_gateway) -> str:
+    return hash_key(str(serial_number), _coordinate(latitude), _coordinate(longitude), id_gateway)
+
+
+def jsc_fingerprint(fixture: Fixture) -> str:
+    return hash_key(str(fixture.name), _coordinate(fixture.latitude), _coordinate(fixture.longitude), fixture.ident)
+
+
+def _sql_literal(value) -> str:
+    return "'" + str(value).replace("'", "''") + "'"
+
+
+def gis_fingerprint(gis_item: GisItem) -> str:
+    return hash_key(
+        gis_item.sn_nema,
+        gis_item.old_sn,
+        gis_item.jnet_type,
+        gis_item.type_switches,
+        _coordinate(gis_item.coordinate.lat),
+        _coordinate(gis_item.coordinate.long),
+    )
+
+
+class ReconcileState:
+    def __init__(self, path):
+        Path(path).parent.mkdir(parents=True, exist_ok=True)
+        self._conn = sqlite3.connect(str(path), check_same_thread=False, isolation_level=None)
+        self._conn.execute("CREATE TABLE IF NOT EXISTS watermarks (source TEXT PRIMARY KEY, value TEXT NOT NULL)")
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS fingerprints (serial TEXT PRIMARY KEY, hash TEXT NOT NULL, updated_at REAL)"
+        )
+        self._lock = threading.Lock()
+
+    def get_watermark(self, source: str) -> Optional[str]:
+        with self._lock:
+            row = self._conn.execute("SELECT value FROM watermarks WHERE source = ?", (source,)).fetchone()
+        return row[0] if row else None
+
+    def set_watermark(self, source: str, value: str):
+        with self._lock:
+            self._conn.execute("INSERT OR REPLACE INTO watermarks (source, value) VALUES (?, ?)", (source, value))
+
+    def get_fingerprints(self, serials: Iterable[str]) -> Dict[str, str]:
+        serials = list(serials)
+        fingerprints = {}
+        with self._lock:
+            for chunk_start in range(0, len(serials), 500):
+                chunk = serials[chunk_start : chunk_start + 500]
+                placeholders = ",".join("?" * len(chunk))
+                rows = self._conn.execute(
+                    f"SELECT serial, hash FROM fingerprints WHERE serial IN ({placeholders})",
+                    chunk,
+                )
+                fingerprints.update(rows)
+        return fingerprints
+
+    def set_fingerprints(self, fingerprints: Dict[str, str]):
+        now = time.time()
+        with self._lock:
+            self._conn.execute("BEGIN")
+            self._conn.executemany(
+                "INSERT OR REPLACE INTO fingerprints (serial, hash, updated_at) VALUES (?, ?, ?)",
+                [(serial, fingerprint, now) for serial, fingerprint in fingerprints.items()],
+            )
+            self._conn.execute("COMMIT")
+
+    def close(self):
+        with self._lock:
+            self._conn.close()
+
+
+@dataclass
+class ReconcilePlan:
+    lms_upserts: List[DeviceData] = field(default_factory=list)
+    relay_groups: Dict[str, int] = field(default_factory=dict)
+    lms_deletes: List[str] = field(default_factory=list)
+    jsc_inserts: List[Fixture] = field(default_factory=list)
+    jsc_updates: List[Fixture] = field(default_factory=list)
+    jsc_deletes: List[str] = field(default_factory=list)
+    lms_prunes: List[str] = field(default_factory=list)
+    jsc_prunes: List[str] = field(default_factory=list)
+    rejected: List[str] = field(default_factory=list)
+
+    def is_empty(self) -> bool:
+        return not any(
+            (self.lms_upserts, self.lms_deletes, self.jsc_inserts, self.jsc_updates, self.jsc_deletes),
+        )
+
+
+@dataclass
+class FetchedFeatures:
+    gis_items: List[GisItem] = field(default_factory=list)
+    modified_at: Dict[str, object] = field(default_factory=dict)
+    unparsed: int = 0
+    incomplete: bool = False
+
+
+@dataclass
+class ReconcileReport:
+    full_scan: bool
+    dry_run: bool
+    watermark: Optional[str] = None
+    features: int = 0
+    unchanged: int = 0
+    lms_upserts: int = 0
+    lms_deletes: int = 0
+    jsc_inserts: int = 0
+    jsc_updates: int = 0
+    jsc_deletes: int = 0
+    rejected: int = 0
+    unparsed: int = 0
+    incomplete: bool = False
+    lms_prunes: int = 0
+    jsc_prunes: int = 0
+    prune_skipped: Optional[str] = None
+    failed: List[str] = field(default_factory=list)
+    duration: float = 0.0
+
+
+class Reconciler:
+    def __init__(
+        self,
+        lms_request: LMSRequest,
+        gis_handler: GisCloudHandler,
+        conn_settings: ConnectionSettings,
+        state: ReconcileState,
+        layer_id,
+        modified_field: str = "modified",
+        max_prune_deletes: int = PRUNE_MAX_DELETES,
+        max_prune_ratio: float = PRUNE_MAX_RATIO,
+    ):
+        # the field name goes into the feature filter as is, only a plain column name is accepted
+        if not re.fullmatch(r"[A-Za-z_][A-Za-z0-9_]*", modified_field):
+            raise ValueError(f"invalid giscloud modification field: {modified_field!r}")
+        self.lms_request = lms_request
+        self.gis_handler = gis_handler
+        self.conn_settings = conn_settings
+        self.state = state
+        self.layer_id = layer_id
+        self.modified_field = modified_field
+        self.max_prune_deletes = max_prune_deletes
+        self.max_prune_ratio = max_prune_ratio
+
+    def fetch_gis_items(self, watermark: Optional[str]) -> FetchedFeatures:
+        where = f"{self.modified_field} >= {_sql_literal(watermark)}" if watermark else None
+        fetched = FetchedFeatures()
+        gis_items: Dict[str, GisItem] = {}
+        try:
+            for feature in self.gis_handler.iter_features(self.layer_id, where=where, order_by=self.modified_field):
+                data = dict(feature.get("data") or {})
+                data.setdefault("ogc_fid", feature.get("id"))
+                try:
+                    gis_item = parse_gis_item({"data": data})
+                except Exception:
+                    logger.warning(
+                        "skipping unparsable giscloud feature",
+                        exc_info=True,
+                        extra={"id": feature.get("id")},
+                    )
+                    fetched.unparsed += 1
+                    continue
+                known = gis_items.get(gis_item.sn_nema)
+                if known is None or known.datetime <= gis_item.datetime:
+                    gis_items[gis_item.sn_nema] = gis_item
+                    modified_at = data.get(self.modified_field, feature.get(self.modified_field))
+                    if modified_at is None:
+                        fetched.modified_at.pop(gis_item.sn_nema, None)
+                    else:
+                        fetched.modified_at[gis_item.sn_nema] = modified_at
+        except IncompleteFeaturesError:
+            logger.warning("giscloud feature listing was incomplete", exc_info=True)
+            fetched.incomplete = True
+        fetched.gis_items = list(gis_items.values())
+        return fetched
+
+    def fetch_lms_devices(self, relay_group_ids: Iterable[int]) -> Dict[str, dict]:
+        # the LMS API has no changed-since filter, the group listing is a single call that also refreshes the inventory
+        devices = self.lms_request.get_all_devices(LMS_DEVICES_GROUP_ID)
+        self.lms_request.inventory.load(LMS_DEVICES_GROUP_ID, devices)
+        self.lms_request.inventory.warm({group_id for group_id in relay_group_ids if group_id is not None})
+        return {str(device["serialNumber"]): device for device in device_list(devices) if device.get("serialNumber")}
+
+    def plan(
+        self,
+        gis_items: List[GisItem],
+        lms_devices: Dict[str, dict],
+        jsc_fixtures: Dict[str, Fixture],
+        prune: bool = False,
+    ) -> ReconcilePlan:
+        plan = ReconcilePlan()
+        jnet_0_items = [gis_item for gis_item in gis_items if gis_item.jnet_type == "Jnet0"]
+        gateway_ids = polygon_handler.get_gateway_ids(
+            lons=[gis_item.coordinate.long for gis_item in jnet_0_items],
+            lats=[gis_item.coordinate.lat for gis_item in jnet_0_items],
+        )
+        gateway_by_serial = {gis_item.sn_nema: ident for gis_item, ident in zip(jnet_0_items, gateway_ids)}
+
+        for gis_item in gis_items:
+            if gis_item.jnet_type not in ("Jnet0", "Jnet1"):
+                continue
+            serial_number = gis_item.sn_nema
+            # like the webhook, a Jnet0 fixture outside every gateway polygon is left out of LMS and JSC
+            if gis_item.jnet_type == "Jnet0" and gateway_by_serial.get(serial_number) is None:
+                logger.warning("fixture skipped, no gateway found", extra={"sn_nema": serial_number})
+                plan.rejected.append(serial_number)
+                continue
+            id_gateway = JNET_1_GATEWAY_ID if gis_item.jnet_type == "Jnet1" else JNET_0_GATEWAY_ID
+            device = DeviceData(
+                pole=serial_number,
+                serial_number=serial_number,
+                latitude=gis_item.coordinate.lat,
+                longitude=gis_item.coordinate.long,
+                id_gateway=id_gateway,
+            )
+            current_device = lms_devices.get(serial_number)
+            device_matches = current_device is not None and lms_fingerprint(
+                serial_number,
+                current_device.get("latitude"),
+                current_device.get("longitude"),
+                current_device.get("idGateway"),
+            ) == lms_fingerprint(serial_number, device.latitude, device.longitude, id_gateway)
+            relay_group_id = LMS_GROUPS.get(gis_item.type_switches) if gis_item.jnet_type == "Jnet1" else None
+            relay_matches = relay_group_id is None or self.lms_request.inventory.contains(relay_group_id, serial_number)
+            if not device_matches or not relay_matches:
+                plan.lms_upserts.append(device)
+                if relay_group_id is not None:
+                    plan.relay_groups[serial_number] = relay_group_id
+
+            if gis_item.jnet_type == "Jnet0":
+                fixture = Fixture(
+                    name=serial_number,
+                    latitude=gis_item.coordinate.lat,
+                    longitude=gis_item.coordinate.long,
+                    id_gateway=JNET_0_GATEWAY_ID,
+                    ident=gateway_by_serial.get(serial_number),
+                )
+                current_fixture = jsc_fixtures.get(serial_number)
+                if current_fixture is None:
+                    plan.jsc_inserts.append(fixture)
+                elif jsc_fingerprint(current_fixture) != jsc_fingerprint(fixture):
+                    plan.jsc_updates.append(fixture)
+
+            if has_old_sn(gis_item):
+                if gis_item.old_sn in lms_devices:
+                    plan.lms_deletes.append(gis_item.old_sn)
+                if gis_item.old_sn in jsc_fixtures:
+                    plan.jsc_deletes.append(gis_item.old_sn)
+
+        plan.lms_deletes = list(dict.fromkeys(plan.lms_deletes))
+        plan.jsc_deletes = list(dict.fromkeys(plan.jsc_deletes))
+        if prune:
+            known_serials = {gis_item.sn_nema for gis_item in gis_items}
+            lms_known, jsc_known = known_serials | set(plan.lms_deletes), known_serials | set(plan.jsc_deletes)
+            plan.lms_prunes = [serial for serial in lms_devices if serial not in lms_known]
+            plan.jsc_prunes = [name for name in jsc_fixtures if name not in jsc_known]
+        return plan
+
+    def prune_refusal(
+        self,
+        fetched: FetchedFeatures,
+        plan: ReconcilePlan,
+        lms_devices: Dict[str, dict],
+        jsc_fixtures: Dict[str, Fixture],
+        confirmed: bool,
+    ) -> Optional[str]:
+        # a feature missing from the scan looks exactly like a deleted one, prune only from a clean, complete scan
+        if fetched.unparsed:
+            return f"{fetched.unparsed} giscloud features could not be parsed"
+        if fetched.incomplete:
+            return "the giscloud feature listing was incomplete"
+        for target, prunes, existing in (
+            ("LMS devices", plan.lms_prunes, lms_devices),
+            ("JSC fixtures", plan.jsc_prunes, jsc_fixtures),
+        ):
+            if len(prunes) > self.max_prune_deletes or len(prunes) > self.max_prune_ratio * len(existing):
+                return (
+                    f"{len(prunes)} of {len(existing)} {target} would be pruned, above the limit of "
+                    f"{self.max_prune_deletes} or {self.max_prune_ratio:.0%}"
+                )
+        if not confirmed:
+            return "pruning requires --yes"
+        return None
+
+    def apply(self, plan: ReconcilePlan) -> List[str]:
+        failed = []
+        if plan.jsc_inserts or plan.jsc_updates or plan.jsc_deletes:
+            db_conn = AzureDbConnection(self.conn_settings)
+            try:
+                db_conn.bulk_upsert_fixtures(plan.jsc_inserts + plan.jsc_updates, deleted_names=plan.jsc_deletes)
+                db_conn.conn.commit()
+            except Exception:
+                db_conn.conn.rollback()
+                logger.error("failed to apply fixture changes to azure DB", exc_info=True)
+                failed.extend(fixture.name for fixture in plan.jsc_inserts + plan.jsc_updates)
+                failed.extend(plan.jsc_deletes)
+            finally:
+                db_conn.disconnect()
+
+        if plan.lms_upserts or plan.lms_deletes:
+            with self.lms_request.site_session(LMS_SITE_NAME):
+                upserts = self.lms_request.upsert_devices(
+                    LMS_DEVICES_GROUP_ID,
+                    plan.lms_upserts,
+                    relay_groups=plan.relay_groups,
+                )
+                failed.extend(serial for serial, upsert_result in upserts.items() if not upsert_result.ok)
+                for serial_number in plan.lms_deletes:
+                    try:
+                        delete_result = self.lms_request.delete_device(LMS_DEVICES_GROUP_ID, serial_number)
+                    except Exception as e:
+                        logger.error("failed to delete device", exc_info=True, extra={"serial_number": serial_number})
+                        delete_result = str(e)
+                    if delete_result != "Device deleted successfully.":
+                        failed.append(serial_number)
+        return failed
+
+    def run(
+        self,
+        full: bool = False,
+        prune: bool = False,
+        dry_run: bool = False,
+        confirm_prune: bool = False,
+    ) -> ReconcileReport:
+        started_at = time.perf_counter()
+        watermark = None if full else self.state.get_watermark(GISCLOUD_WATERMARK)
+        full = watermark is None
+        report = ReconcileReport(full_scan=full, dry_run=dry_run, watermark=watermark)
+
+        fetched = self.fetch_gis_items(watermark)
+        gis_items = fetched.gis_items
+        report.features = len(gis_items)
+        report.unparsed = fetched.unparsed
+        report.incomplete = fetched.incomplete
+        fingerprints = {gis_item.sn_nema: gis_fingerprint(gis_item) for gis_item in gis_items}
+        if not full:
+            stored = self.state.get_fingerprints(fingerprints)
+            changed = [
+                gis_item for gis_item in gis_items if stored.get(gis_item.sn_nema) != fingerprints[gis_item.sn_nema]
+            ]
+            report.unchanged = len(gis_items) - len(changed)
+            gis_items = changed
+            if not gis_items:
+                report.duration = time.perf_counter() - started_at
+                logger.info("reconciliation found no changes", extra={"report": asdict(report)})
+                return report
+
+        lms_devices = self.fetch_lms_devices(LMS_GROUPS.get(gis_item.type_switches) for gis_item in gis_items)
+        names = [gis_item.sn_nema for gis_item in gis_items if gis_item.jnet_type == "Jnet0"]
+        names += [gis_item.old_sn for gis_item in gis_items if has_old_sn(gis_item)]
+        jsc_fixtures = {}
+        if full or names:
+            db_conn = AzureDbConnection(self.conn_settings)
+            try:
+                jsc_fixtures = db_conn.get_fixtures(None if full else names)
+            finally:
+                db_conn.disconnect()
+
+        plan = self.plan(gis_items, lms_devices, jsc_fixtures, prune=prune and full)
+        report.lms_prunes = len(plan.lms_prunes)
+        report.jsc_prunes = len(plan.jsc_prunes)
+        if plan.lms_prunes or plan.jsc_prunes:
+            report.prune_skipped = self.prune_refusal(fetched, plan, lms_devices, jsc_fixtures, confirm_prune)
+            if report.prune_skipped is None:
+                plan.lms_deletes += plan.lms_prunes
+                plan.jsc_deletes += plan.jsc_prunes
+            else:
+                logger.warning("pruning skipped", extra={"reason": report.prune_skipped})
+        report.lms_upserts = len(plan.lms_upserts)
+        report.lms_deletes = len(plan.lms_deletes)
+        report.jsc_inserts = len(plan.jsc_inserts)
+        report.jsc_updates = len(plan.jsc_updates)
+        report.jsc_deletes = len(plan.jsc_deletes)
+        report.rejected = len(plan.rejected)
+
+        if not dry_run:
+            report.failed = [] if plan.is_empty() else self.apply(plan)
+            failed = set(report.failed)
+            # no fingerprint for rejected features, the next full scan retries them once the polygons cover them
+            unsynced = failed | set(plan.rejected)
+            self.state.set_fingerprints(
+                {
+                    gis_item.sn_nema: fingerprints[gis_item.sn_nema]
+                    for gis_item in gis_items
+                    if gis_item.sn_nema not in unsynced and gis_item.old_sn not in failed
+                }
+            )
+            # a listing that came back short may have skipped features, scan the same range again next run
+            new_watermark = None if fetched.incomplete else self._next_watermark(gis_items, fetched.modified_at, failed)
+            if new_watermark:
+                self.state.set_watermark(GISCLOUD_WATERMARK, new_watermark)
+                report.watermark = new_watermark
+
+        report.duration = time.perf_counter() - started_at
+        logger.info("reconciliation finished", extra={"report": asdict(report)})
+        return report
+
+    def _next_watermark(self, gis_items: List[GisItem], modified_at: Dict[str, object], failed: set) -> Optional[str]:
+        if not gis_items:
+            return None
+        if any(gis_item.sn_nema not in modified_at for gis_item in gis_items):
+            logger.warning("giscloud features without a modification time, keeping the watermark")
+            return None
+        failed_items = [gis_item for gis_item in gis_items if gis_item.sn_nema in failed or gis_item.old_sn in failed]
+        # the feature query is inclusive, stopping at the oldest failure retries it on the next run
+        if failed_items:
+            return str(min(modified_at[gis_item.sn_nema] for gis_item in failed_items))
+        return str(max(modified_at[gis_item.sn_nema] for gis_item in gis_items))
+
+
+def main():
+    arg_parser = argparse.ArgumentParser(description="Reconcile GIS Cloud features with LMS and the JSC database")
+    arg_parser.add_argument("--state", default=os.getenv("RECONCILE_STATE_PATH", "data/reconcile.sqlite3"))
+    arg_parser.add_argument("--full", action="store_true", help="ignore the stored watermark and scan everything")
+    arg_parser.add_argument("--prune", action="store_true", help="on a full scan, delete devices missing in GIS Cloud")
+    arg_parser.add_argument("--yes", action="store_true", help="apply the prune, without it pruning is only reported")
+    arg_parser.add_argument("--max-prune-deletes", type=int, default=PRUNE_MAX_DELETES)
+    arg_parser.add_argument("--max-prune-ratio", type=float, default=PRUNE_MAX_RATIO)
+    arg_parser.add_argument("--dry-run", action="store_true", help="print the planned changes without applying them")
+    arg_parser.add_argument("--interval", type=float, default=0, help="run every N seconds instead of once")
+    args = arg_parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO)
+    reconciler = Reconciler(
+        lms_request=get_lms_request(),
+        gis_handler=get_gis_handler(),
+        conn_settings=conn_settings,
+        state=ReconcileState(args.state),
+        layer_id=os.getenv("GIS_CLOUD_LAYER_ID"),
+        modified_field=os.getenv("GIS_CLOUD_MODIFIED_FIELD", "modified"),
+        max_prune_deletes=args.max_prune_deletes,
+        max_prune_ratio=args.max_prune_ratio,
+    )
+    while True:
+        report = reconciler.run(full=args.full, prune=args.prune, dry_run=args.dry_run, confirm_prune=args.yes)
+        print(json.dumps(asdict(report), indent=2))
+        if not args.interval:
+            break
+        args.full = False
+        time.sleep(args.interval)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,80 @@
+import argparse
+import asyncio
+import json
+import statistics
+import time
+from collections import Counter
+from pathlib import Path
+from typing import List
+
+import httpx
+
+
+def load_capture(path: Path) -> List[dict]:
+    with path.open(encoding="utf-8") as capture_file:
+        return [json.loads(line)["body"] for line in capture_file if line.strip()]
+
+
+def percentile(values: List[float], pct: float) -> float:
+    if not values:
+        return 0.0
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(round(pct / 100 * (len(ordered) - 1))))]
+
+
+async def replay(bodies: List[dict], url: str, rate: float, concurrency: int, timeout: float) -> dict:
+    latencies, statuses = [], Counter()
+    semaphore = asyncio.Semaphore(concurrency)
+    limits = httpx.Limits(max_connections=concurrency, max_keepalive_connections=concurrency)
+
+    async with httpx.AsyncClient(timeout=timeout, limits=limits) as client:
+
+        async def send(body: dict):
+            async with semaphore:
+                started_at = time.perf_counter()
+                try:
+                    response = await client.post(url, json=body)
+                    statuses[response.status_code] += 1
+                except httpx.HTTPError as e:
+                    statuses[type(e).__name__] += 1
+                latencies.append(time.perf_counter() - started_at)
+
+        started_at = time.perf_counter()
+        tasks = []
+        for index, body in enumerate(bodies):
+            if rate > 0:
+                # open-loop schedule: requests leave at the target rate whatever the app's latency is
+                await asyncio.sleep(max(0.0, started_at + index / rate - time.perf_counter()))
+            tasks.append(asyncio.create_task(send(body)))
+        await asyncio.gather(*tasks)
+        elapsed = time.perf_counter() - started_at
+
+    return {
+        "requests": len(bodies),
+        "elapsed_s": round(elapsed, 3),
+        "throughput_rps": round(len(bodies) / elapsed, 2) if elapsed else 0.0,
+        "p50_ms": round(percentile(latencies, 50) * 1000, 1),
+        "p95_ms": round(percentile(latencies, 95) * 1000, 1),
+        "p99_ms": round(percentile(latencies, 99) * 1000, 1),
+        "mean_ms": round(statistics.fmean(latencies) * 1000, 1) if latencies else 0.0,
+        "statuses": {str(status): count for status, count in statuses.items()},
+    }
+
+
+def main():
+    arg_parser = argparse.ArgumentParser(description="Replay a captured /giscloud traffic file against the app")
+    arg_parser.add_argument("capture", type=Path, help="JSONL file written with GISCLOUD_CAPTURE_PATH")
+    arg_parser.add_argument("--url", default="http://127.0.0.1:8080/giscloud")
+    arg_parser.add_argument("--rate", type=float, default=10.0, help="requests per second, 0 for as fast as possible")
+    arg_parser.add_argument("--concurrency", type=int, default=20)
+    arg_parser.add_argument("--repeat", type=int, default=1, help="replay the capture this many times")
+    arg_parser.add_argument("--timeout", type=float, default=60.0)
+    args = arg_parser.parse_args()
+
+    bodies = load_capture(args.capture) * args.repeat
+    report = asyncio.run(replay(bodies, args.url, args.rate, args.concurrency, args.timeout))
+    print(json.dumps(report, indent=2))
+
+
+if __name__ == "__main__":
+    main()
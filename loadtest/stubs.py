@@ -0,0 +1,123 @@
+import argparse
+import json
+import random
+import re
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from logging import getLogger
+
+logger = getLogger(__name__)
+
+MONDAY_ALIAS = re.compile(r"(\w+):\s*create_item\(")
+
+
+class LatencyHandler(BaseHTTPRequestHandler):
+    latency = 0.0
+    jitter = 0.0
+    protocol_version = "HTTP/1.1"
+
+    def log_message(self, format, *args):
+        pass
+
+    def _sleep(self):
+        delay = self.latency + random.uniform(0, self.jitter)
+        if delay > 0:
+            time.sleep(delay)
+
+    def _read_body(self) -> bytes:
+        length = int(self.headers.get("Content-Length") or 0)
+        return self.rfile.read(length) if length else b""
+
+    def _reply(self, payload, status: int = 200, content_type: str = "application/json"):
+        body = payload if isinstance(payload, bytes) else json.dumps(payload).encode()
+        self.send_response(status)
+        self.send_header("Content-Type", content_type)
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+
+class LMSStubHandler(LatencyHandler):
+    def do_GET(self):
+        self._sleep()
+        self._reply([] if self.path.endswith("/devices") else {})
+
+    def do_POST(self):
+        self._read_body()
+        self._sleep()
+        if self.path == "/token":
+            self._reply({"access_token": "stub-token", "token_type": "bearer", "expires_in": 86400})
+        else:
+            self._reply({"result": "ok"})
+
+    def do_PUT(self):
+        self._read_body()
+        self._sleep()
+        self._reply({"result": "ok"})
+
+    def do_DELETE(self):
+        self._sleep()
+        self._reply({"result": "ok"})
+
+
+class MondayStubHandler(LatencyHandler):
+    def do_POST(self):
+        body = self._read_body()
+        self._sleep()
+        if self.headers.get("Content-Type", "").startswith("multipart/form-data"):
+            self._reply({"data": {"add_file_to_column": {"id": "1"}}})
+            return
+        query = json.loads(body or b"{}").get("query", "")
+        aliases = MONDAY_ALIAS.findall(query)
+        data = {alias: {"id": str(random.randint(1, 10**9))} for alias in aliases}
+        if not aliases:
+            data["create_item"] = {"id": str(random.randint(1, 10**9))}
+        self._reply({"data": data})
+
+
+class GisCloudStubHandler(LatencyHandler):
+    picture = bytes(64 * 1024)
+
+    def do_GET(self):
+        self._sleep()
+        self._reply(self.picture, content_type="image/jpeg")
+
+
+def serve(handler: type, port: int, latency: float, jitter: float) -> ThreadingHTTPServer:
+    handler_class = type(handler.__name__, (handler,), {"latency": latency, "jitter": jitter})
+    server = ThreadingHTTPServer(("127.0.0.1", port), handler_class)
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, name=f"stub-{handler.__name__}", daemon=True).start()
+    return server
+
+
+def main():
+    arg_parser = argparse.ArgumentParser(description="Local stand-ins for LMS, Monday and GIS Cloud")
+    arg_parser.add_argument("--lms-port", type=int, default=9101)
+    arg_parser.add_argument("--monday-port", type=int, default=9102)
+    arg_parser.add_argument("--giscloud-port", type=int, default=9103)
+    arg_parser.add_argument("--lms-latency", type=float, default=0.05)
+    arg_parser.add_argument("--monday-latency", type=float, default=0.3)
+    arg_parser.add_argument("--giscloud-latency", type=float, default=0.2)
+    arg_parser.add_argument("--jitter", type=float, default=0.02)
+    args = arg_parser.parse_args()
+
+    serve(LMSStubHandler, args.lms_port, args.lms_latency, args.jitter)
+    serve(MondayStubHandler, args.monday_port, args.monday_latency, args.jitter)
+    serve(GisCloudStubHandler, args.giscloud_port, args.giscloud_latency, args.jitter)
+
+    print("stubs are running, start the app with:")
+    print(f"  LMS_API_BASEURL=http://127.0.0.1:{args.lms_port}")
+    print(f"  MONDAY_API_URL=http://127.0.0.1:{args.monday_port}/v2")
+    print(f"  GIS_CLOUD_PICTURES_URL=http://127.0.0.1:{args.giscloud_port}/")
+    print("  GISCLOUD_IDEMPOTENCY_TTL=0  (otherwise repeated captures are answered from the idempotency cache)")
+    try:
+        while True:
+            time.sleep(3600)
+    except KeyboardInterrupt:
+        pass
+
+
+if __name__ == "__main__":
+    main()
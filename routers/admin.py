@@ -0,0 +1,83 @@
+from typing import Optional
+
+from fastapi import APIRouter, Depends, HTTPException, Query
+from fastapi.responses import HTMLResponse, PlainTextResponse
+from pydantic import BaseModel, Field
+
+from dependencies import (
+    get_job_queue,
+    get_picture_queue,
+    get_profiler,
+    verify_admin_token,
+)
+
+router = APIRouter(prefix="/admin", dependencies=[Depends(verify_admin_token)], include_in_schema=False)
+
+
+JOB_QUEUES = {
+    "giscloud": get_job_queue,
+    "pictures": get_picture_queue,
+}
+
+
+class ProfilerSettings(BaseModel):
+    rate: Optional[float] = Field(None, gt=0, le=1)
+    requests: Optional[int] = Field(None, gt=0)
+    interval_ms: Optional[float] = Field(None, ge=1, le=1000)
+
+
+@router.post("/profiler/start")
+async def start_profiler(settings: ProfilerSettings):
+    if not settings.rate and not settings.requests:
+        raise HTTPException(status_code=400, detail="Either rate or requests is required")
+    profiler = get_profiler()
+    profiler.start(
+        rate=settings.rate,
+        requests=settings.requests,
+        interval=settings.interval_ms / 1000 if settings.interval_ms else None,
+    )
+    return profiler.status()
+
+
+@router.post("/profiler/stop")
+async def stop_profiler():
+    profiler = get_profiler()
+    profiler.stop()
+    return profiler.status()
+
+
+@router.get("/profiler")
+async def profiler_status():
+    return get_profiler().status()
+
+
+@router.get("/profiler/profile")
+async def profiler_profile(format: str = "collapsed"):
+    profiler = get_profiler()
+    if format == "collapsed":
+        return PlainTextResponse(
+            profiler.collapsed(),
+            headers={"Content-Disposition": "attachment; filename=synchronizer.collapsed"},
+        )
+    if format == "html":
+        return HTMLResponse(profiler.html_report())
+    raise HTTPException(status_code=400, detail="Unknown format, expected collapsed or html")
+
+
+def _job_queue(queue: str):
+    if queue not in JOB_QUEUES:
+        raise HTTPException(status_code=400, detail=f"Unknown queue, expected one of {', '.join(JOB_QUEUES)}")
+    return JOB_QUEUES[queue]()
+
+
+@router.get("/jobs")
+async def list_jobs(queue: str = "giscloud", status: str = "failed", limit: int = Query(100, gt=0, le=1000)):
+    job_queue = _job_queue(queue)
+    return {"counts": job_queue.counts(), "jobs": job_queue.list_jobs(status, limit)}
+
+
+@router.post("/jobs/{job_id}/retry")
+async def retry_job(job_id: str, queue: str = "giscloud"):
+    if not _job_queue(queue).retry(job_id):
+        raise HTTPException(status_code=404, detail="No failed job with this id")
+    return {"job_id": job_id, "status": "queued"}
@@ -1,134 +1,105 @@
+import contextvars
 import os
-import re
-from dataclasses import dataclass
-from datetime import datetime
+from concurrent.futures import ThreadPoolExecutor
+from functools import lru_cache
 from logging import getLogger
-from typing import Optional
+from typing import List, Optional, Tuple
 
-from dateutil import parser
 from fastapi import APIRouter, HTTPException, Request
-from requests.exceptions import HTTPError
-
+from fastapi.concurrency import run_in_threadpool
+from fastapi.responses import JSONResponse
+
+from dependencies import (
+    async_mode_enabled,
+    get_gis_handler,
+    get_idempotency_store,
+    get_job_queue,
+    get_lms_request,
+    get_picture_queue,
+    get_profiler,
+)
 from handlers import polygon_handler
-from handlers.giscloud_handler import GisCloudHandler
-from handlers.jsc_hanler import AzureDbConnection, ConnectionSettings, Fixture
-from handlers.lms_requests import DeviceData, LMSRequest
-from handlers.monday_handler import Coordinates, MondayClient, MondayItem
+from handlers.gis_items import GisItem, has_old_sn, parse_gis_item
+from handlers.idempotency import hash_key
+from handlers.job_queue import Job, JobWorkerPool
+from handlers.jsc_hanler import AzureDbConnection, Fixture
+from handlers.lms_requests import DeviceData
+from handlers.monday_handler import MondayClient, MondayItem
+from handlers.settings import (
+    JNET_0_GATEWAY_ID,
+    JNET_1_GATEWAY_ID,
+    LMS_DEVICES_GROUP_ID,
+    LMS_GROUPS,
+    LMS_SITE_NAME,
+    conn_settings,
+)
+from handlers.traffic_capture import TrafficCapture
 
 logger = getLogger("giscloud")
 
 router = APIRouter()
 
 
-lms_base_url = os.getenv("LMS_API_BASEURL")
-lms_request = LMSRequest(lms_base_url)
-gis_handler = GisCloudHandler(os.getenv("GIS_CLOUD_API_KEY"))
+lms_request = get_lms_request()
+gis_handler = get_gis_handler()
+monday_handler = MondayClient(os.getenv("MONDAY_API_KEY"), base_url=os.getenv("MONDAY_API_URL"))
+traffic_capture = TrafficCapture(os.getenv("GISCLOUD_CAPTURE_PATH"))
+workflow_executor = ThreadPoolExecutor(max_workers=16, thread_name_prefix="giscloud-workflow")
 
-conn_settings = ConnectionSettings(
-    server=os.getenv("DB_HOST"),
-    database=os.getenv("DB_NAME"),
-    username=os.getenv("DB_USER"),
-    password=os.getenv("DB_PASSWORD"),
-)
 
-LMS_GROUPS = {
-    "Illuminated flag": 286,
-    "grilanda": 284,
-    "Pedestrian sign": 282,
-    "tree switches": 280,
-    "Or Yehuda Garden Flood": 288,
-    "roundabout button": 283,
-    "Logo sign": 285,
-    "football switches": 346,
-    "24/7 sign": 372,
-    "V-led": 369,
-}
-
-
-@dataclass
-class GisItem:
-    feature_id: int
-    sn_nema: str
-    datetime: datetime
-    coordinate: Coordinates
-    picture: str
-    note: str
-    old_sn: str
-    type_switches: str
-    lamp_type: str
-    reason: str
-    jnet_type: str
+def with_request_context(func):
+    # executor threads don't inherit contextvars, carry the request's stage timings over to them and let
+    # the profiler sample the thread while it works for a profiled request
+    context = contextvars.copy_context()
+    profiler = get_profiler()
 
+    def tracked(*args, **kwargs):
+        with profiler.track_thread():
+            return func(*args, **kwargs)
 
-async def extract_gis_item(req: Request) -> GisItem:
-    request_body = await req.json()
-
-    if "data" not in request_body:
-        raise HTTPException(
-            status_code=400,
-            detail="Invalid request body",
-        )
+    def run(*args, **kwargs):
+        return context.copy().run(tracked, *args, **kwargs)
 
-    logger.info("extracting gis item from request body", extra={"request_body": request_body})
+    return run
 
-    data = request_body["data"]
-    sn_nema = extract_sn_nema_from_barcode(data["sn_nema"])
 
-    return GisItem(
-        jnet_type=assign_jnet_type(sn_nema),
-        feature_id=int(data["ogc_fid"]),
-        sn_nema=sn_nema,
-        old_sn=extract_sn_nema_from_barcode(data["old_sn"]),
-        datetime=parser.isoparse(data["date"]),
-        coordinate=Coordinates(
-            long=float(data["longitude"]),
-            lat=float(data["latitude"]),
-        ),
-        picture=data["picture"],
-        note=data["note"],
-        type_switches=data["type_switches"],
-        lamp_type=data["lamp_type"],
-        reason=data["svg"],
-    )
+async def extract_gis_item(req: Request) -> GisItem:
+    return parse_gis_item(await req.json())
 
 
 def handle_jnet_1(gis_item: GisItem) -> dict:
+    with lms_request.site_session(LMS_SITE_NAME):
+        return _handle_jnet_1_in_session(gis_item)
+
+
+def _handle_jnet_1_in_session(gis_item: GisItem) -> dict:
     new_fixture = DeviceData(
         pole=gis_item.sn_nema,
         serial_number=gis_item.sn_nema,
         latitude=gis_item.coordinate.lat,
         longitude=gis_item.coordinate.long,
-        id_gateway=14,
+        id_gateway=JNET_1_GATEWAY_ID,
     )
-    lms_request.session("Or Yehuda - Israel")
     new_fixture_json = new_fixture.to_json()
 
-    new_sn = lms_request.create_device(
-        group_id=259,
-        device_data=new_fixture_json,
+    upsert_result = lms_request.upsert_device(
+        group_id=LMS_DEVICES_GROUP_ID,
+        device=new_fixture,
+        relay_group_id=LMS_GROUPS.get(gis_item.type_switches),
     )
+    new_sn = upsert_result.response
 
     results = {}
 
-    if new_sn == "duplicate entry, you can not insert records that already exist":
-        logger.info("fixture already exists in LMS", extra={"sn_nema": gis_item.sn_nema})
-
-        try:
-            new_sn = lms_request.update_device(
-                group_id=259,
-                device_data=new_fixture_json,
-                serial_number=new_fixture.get_serial_number(),
-            )
-            logger.info("fixture updated successfully to LMS", extra={"new_sn": new_sn, "sn_nema": gis_item.sn_nema})
-            results["LMS result"] = f"{gis_item.sn_nema} updated to LMS"
-        except HTTPError:
-            logger.error(
-                "fixture has not been updated",
-                exc_info=True,
-                extra={"sn_nema": gis_item.sn_nema, "fixture_info": new_fixture_json},
-            )
-            results["LMS result"] = f"failed to insert fixture {gis_item.sn_nema}"
-
+    if not upsert_result.ok:
+        logger.error(
+            "fixture has not been inserted or updated",
+            extra={"sn_nema": gis_item.sn_nema, "fixture_info": new_fixture_json, "error": upsert_result.error},
+        )
+        results["LMS result"] = f"failed to insert fixture {gis_item.sn_nema}"
+    elif upsert_result.action == "updated":
+        logger.info("fixture updated successfully to LMS", extra={"new_sn": new_sn, "sn_nema": gis_item.sn_nema})
+        results["LMS result"] = f"{gis_item.sn_nema} updated to LMS"
     else:
         logger.info("fixture inserted successfully to LMS", extra={"new_sn": new_sn, "sn_nema": gis_item.sn_nema})
         results["LMS result"] = f"{gis_item.sn_nema} inserted to LMS"
@@ -136,10 +107,14 @@ def handle_jnet_1(gis_item: GisItem) -> dict:
     results["new_sn"] = new_sn
     results["fixture_info"] = new_fixture_json
     logger.info("fixture info", extra={"fixture_info": new_fixture_json})
+    if upsert_result.group_response is not None:
+        results["group associate result"] = upsert_result.group_response
+    if upsert_result.group_error is not None:
+        results["group associate result"] = f"failed to associate fixture to relay group: {upsert_result.group_error}"
 
     if gis_item.old_sn:
         try:
-            old_sn_res = lms_request.delete_device(group_id=259, serial_number=gis_item.old_sn)
+            old_sn_res = lms_request.delete_device(group_id=LMS_DEVICES_GROUP_ID, serial_number=gis_item.old_sn)
             logger.info("fixture deleted successfully from LMS", extra={"old_sn": gis_item.old_sn})
             results["delete old fixture"] = f"fixture {gis_item.old_sn} deleted successfully"
             results["old sn result"] = old_sn_res
@@ -149,139 +124,478 @@ def handle_jnet_1(gis_item: GisItem) -> dict:
             results["error"] = str(e)
             raise HTTPException(status_code=500) from e
 
-    if gis_item.type_switches in LMS_GROUPS.keys():
-        relay_group_id = LMS_GROUPS[gis_item.type_switches]
-        group_result = lms_request.associate_device_to_group(group_id=relay_group_id, serial_number=gis_item.sn_nema)
-        results["group associate result"] = group_result
-
     return results
 
 
+def no_gateway_result(gis_item: GisItem) -> dict:
+    # JSC can't take a fixture without its gateway, the feature is rejected instead of written with an empty ident
+    return {
+        "JSC result": (
+            f"fixture {gis_item.sn_nema} is not within {polygon_handler.max_gateway_distance:g} m of a gateway polygon"
+        ),
+        "Status": "Failed",
+        "Message": "Item Failed to added to LMS OR Azure DB, for more details check the log or the result fields",
+    }
+
+
 def handle_jnet_0(gis_item: GisItem) -> dict:
-    db_conn = AzureDbConnection(conn_settings)
+    gateway_id = polygon_handler.get_gateway_id(
+        lon=gis_item.coordinate.long,
+        lat=gis_item.coordinate.lat,
+    )
+    if gateway_id is None:
+        logger.error("fixture rejected, no gateway found", extra={"sn_nema": gis_item.sn_nema})
+        return no_gateway_result(gis_item)
     new_fixture = Fixture(
         name=gis_item.sn_nema,
         latitude=gis_item.coordinate.lat,
         longitude=gis_item.coordinate.long,
-        id_gateway=19,
-        ident=polygon_handler.get_gateway_id(
-            lon=gis_item.coordinate.long,
-            lat=gis_item.coordinate.lat,
-        ),
+        id_gateway=JNET_0_GATEWAY_ID,
+        ident=gateway_id,
     )
     new_device = DeviceData(
         serial_number=gis_item.sn_nema,
         pole=gis_item.sn_nema,
         latitude=gis_item.coordinate.lat,
         longitude=gis_item.coordinate.long,
-        id_gateway=19,
+        id_gateway=JNET_0_GATEWAY_ID,
     )
     fixture_dict = new_fixture.to_dict()
+    results = {}
+    inserted = False
+    db_conn = AzureDbConnection(conn_settings)
+    # the pooled connection goes back even when the old_sn cleanup raises
     try:
-        results = {}
-        if db_conn.fixture_exists(gis_item.sn_nema):
-            fixture_id_res = db_conn.update_fixture(new_fixture, fixture_name=gis_item.sn_nema)
-            logger.info("fixture updated successfully to azure DB", extra={"fixture_id_res": fixture_id_res})
-        else:
-            fixture_id_res = db_conn.insert_fixture(new_fixture)
-            results["JSC result"] = f"{gis_item.sn_nema} inserted to JSC, result = {fixture_id_res}"
-            logger.info(
-                "fixture inserted successfully to azure DB",
-                extra={"fixture_id_res": fixture_id_res, "fixure_info": fixture_dict},
-            )
-            device_res = lms_request.create_device(group_id=259, device_data=new_device.to_json())
-            logger.info("fixture inserted successfully to LMS", extra={"device_res": device_res})
-            results["LMS result"] = f"{gis_item.sn_nema} inserted to LMS, result = {device_res}"
-        results["fixture_info"] = new_fixture.to_dict()
-    except Exception as e:
-        db_conn.conn.rollback()
-        logger.error("failed to insert fixture", exc_info=True, extra={"fixture_info": fixture_dict})
-        results["JSC result"] = f"Failed to insert fixture {gis_item.sn_nema} to DB: {e}"
-    if gis_item.old_sn is not None and gis_item.old_sn != "None":
         try:
-            lms_request.delete_device(group_id=259, serial_number=gis_item.old_sn)
-            db_conn.delete_fixture(fixture_name=gis_item.old_sn)
-            results["delete old fixture"] = f"fixture {gis_item.old_sn} deleted successfully from JSC and LMS"
+            fixture_id_res, inserted = db_conn.upsert_fixture(new_fixture)
+            if inserted:
+                results["JSC result"] = f"{gis_item.sn_nema} inserted to JSC, result = {fixture_id_res}"
+                logger.info(
+                    "fixture inserted successfully to azure DB",
+                    extra={"fixture_id_res": fixture_id_res, "fixure_info": fixture_dict},
+                )
+            else:
+                logger.info("fixture updated successfully to azure DB", extra={"fixture_id_res": fixture_id_res})
+            results["fixture_info"] = new_fixture.to_dict()
         except Exception as e:
-            logger.error("fixture not been deleted", exc_info=True, extra={"old_sn": gis_item.old_sn})
-            results[
-                "delete old fixture"
-            ] = f"Failed to delete fixture {gis_item.old_sn} from LMS or azure DB. Error: {e}"
-            raise e
-
-    db_conn.conn.commit()
-    db_conn.disconnect()
+            db_conn.conn.rollback()
+            logger.error("failed to insert fixture", exc_info=True, extra={"fixture_info": fixture_dict})
+            results["JSC result"] = f"Failed to insert fixture {gis_item.sn_nema} to DB: {e}"
+        if inserted:
+            # the LMS outcome is reported next to the JSC one, it never rolls back the fixture row
+            device_res = lms_request.upsert_device(group_id=LMS_DEVICES_GROUP_ID, device=new_device)
+            if device_res.ok:
+                logger.info("fixture upserted successfully to LMS", extra={"device_res": device_res.to_json()})
+                results["LMS result"] = f"{gis_item.sn_nema} {device_res.action} in LMS, result = {device_res.response}"
+            else:
+                logger.error(
+                    "fixture has not been inserted or updated in LMS",
+                    extra={"sn_nema": gis_item.sn_nema, "error": device_res.error},
+                )
+                results["LMS result"] = f"failed to upsert fixture {gis_item.sn_nema} in LMS: {device_res.error}"
+        if gis_item.old_sn is not None and gis_item.old_sn != "None":
+            try:
+                lms_request.delete_device(group_id=LMS_DEVICES_GROUP_ID, serial_number=gis_item.old_sn)
+                db_conn.delete_fixture(fixture_name=gis_item.old_sn)
+                results["delete old fixture"] = f"fixture {gis_item.old_sn} deleted successfully from JSC and LMS"
+            except Exception as e:
+                logger.error("fixture not been deleted", exc_info=True, extra={"old_sn": gis_item.old_sn})
+                results[
+                    "delete old fixture"
+                ] = f"Failed to delete fixture {gis_item.old_sn} from LMS or azure DB. Error: {e}"
+                raise e
+
+        db_conn.conn.commit()
+    finally:
+        db_conn.disconnect()
     results["Status"] = "Pass"
     results["Message"] = "Item added to LMS and Azure DB"
     return results
 
 
-def extract_sn_nema_from_barcode(barcode: Optional[str]) -> Optional[str]:
-    if barcode is not None:
-        regex_result = re.search(r"([1-9][0-9]*\d{6,8})", barcode)
-        return regex_result.group() if regex_result else barcode
-    return barcode
+def warm_lms_inventory():
+    lms_request.inventory.warm([LMS_DEVICES_GROUP_ID, *LMS_GROUPS.values()])
+
+
+def fetch_picture(gis_item: GisItem) -> Optional[bytes]:
+    if not gis_item.picture:
+        return None
+    try:
+        return gis_handler.get_picture(
+            layer_id=os.getenv("GIS_CLOUD_LAYER_ID"),
+            feature_id=gis_item.feature_id,
+            file_name=gis_item.picture,
+        )
+    except Exception:
+        logger.error("failed to download picture from giscloud", exc_info=True, extra={"sn_nema": gis_item.sn_nema})
+        return None
 
 
-def assign_jnet_type(regex_result: str) -> str:
-    if regex_result and regex_result.startswith("103"):
-        return "Jnet1"
-    elif regex_result and regex_result[:3] in ["402", "750", "220", "470", "200", "400", "120"]:
-        return "Jnet0"
+def handle_fixture(gis_item: GisItem) -> dict:
+    if gis_item.jnet_type == "Jnet1":
+        logger.info("fixture type is a Jnet1", extra={"sn_nema": gis_item.sn_nema})
+        return handle_jnet_1(gis_item=gis_item)
+    elif gis_item.jnet_type == "Jnet0":
+        logger.info("fixture type is a Jnet0", extra={"sn_nema": gis_item.sn_nema})
+        return handle_jnet_0(gis_item=gis_item)
     else:
-        return "Unknown"
+        logger.warning("fixture type is unknown", extra={"sn_nema": gis_item.sn_nema})
+        return {
+            "LMS result": f"fixture {gis_item.sn_nema} is not a Jnet fixture",
+            "Status": "Failed",
+            "Message": "Item Failed to added to LMS OR Azure DB, for more details check the log or the result fields",
+        }
 
 
-@router.post("/giscloud")
-async def new_item(request: Request):
-    logger.info("new webhook request from giscloud")
-    gis_item = await extract_gis_item(request)
+def upload_picture(item_id: str, picture_raw_data: Optional[bytes]):
+    if not picture_raw_data:
+        return
+    response = monday_handler.add_item_picture(item_id=item_id, image_raw_data=picture_raw_data)
+    response.raise_for_status()
+    logger.info("picture uploaded to monday", extra={"item_id": item_id})
+
+
+def upload_picture_or_retry(gis_item: GisItem, item_id: Optional[str], picture_raw_data: Optional[bytes]):
+    if not item_id or not gis_item.picture:
+        return
+    if picture_raw_data:
+        try:
+            upload_picture(item_id, picture_raw_data)
+            return
+        except Exception:
+            logger.error("failed to upload picture to monday", exc_info=True, extra={"item_id": item_id})
+    # the monday item already exists, failing the webhook would make GIS Cloud redeliver it and create a second
+    # item, so the picture is retried on its own from the picture queue
+    try:
+        job_id = get_picture_queue().enqueue(
+            {"item_id": item_id, "feature_id": gis_item.feature_id, "picture": gis_item.picture}
+        )
+    except Exception:
+        logger.error("failed to queue monday picture upload", exc_info=True, extra={"item_id": item_id})
+        return
+    get_picture_workers().notify()
+    logger.info("monday picture upload queued for retry", extra={"item_id": item_id, "job_id": job_id})
 
-    logger.info("initializing monday handler")
-    monday_api_key = os.getenv("MONDAY_API_KEY")
-    monday_handler = MondayClient(monday_api_key)
 
+def process_picture_job(payload: dict):
     picture_raw_data = gis_handler.get_picture(
         layer_id=os.getenv("GIS_CLOUD_LAYER_ID"),
-        feature_id=gis_item.feature_id,
-        file_name=gis_item.picture,
+        feature_id=payload["feature_id"],
+        file_name=payload["picture"],
     )
+    upload_picture(payload["item_id"], picture_raw_data)
+
+
+def run_workflow(gis_item: GisItem):
+    # picture download -> picture upload runs next to LMS/JSC -> monday item, the upload joins both branches
+    picture_future = workflow_executor.submit(with_request_context(fetch_picture), gis_item)
+    results = handle_fixture(gis_item)
+    logger.info("giscloud webhook workflow has finished", extra={"results": results})
 
     monday_item = MondayItem(
         sn_nema=gis_item.sn_nema,
         insertion_date=gis_item.datetime,
         coordinates=gis_item.coordinate,
         picture=gis_item.picture,
-        picture_raw_data=picture_raw_data,
         notes=gis_item.note,
         old_sn=gis_item.old_sn,
         type_switch=gis_item.type_switches,
         lamp_type=gis_item.lamp_type,
         reason=gis_item.reason,
-        webhook_response={},
+        webhook_response=results,
+    )
+    item_id = monday_handler.add_item(
+        board_id=int(os.getenv("MONDAY_BOARD_ID")),
+        group_id=os.getenv("MONDAY_GROUP_ID"),
+        item=monday_item,
     )
+    upload_picture_or_retry(gis_item, item_id, picture_future.result())
+    return item_id
 
-    board_id = int(os.getenv("MONDAY_BOARD_ID"))
-    group_id = os.getenv("MONDAY_GROUP_ID")
 
-    if gis_item.jnet_type == "Jnet1":
-        logger.info("fixture type is a Jnet1", extra={"sn_nema": gis_item.sn_nema})
-        results = handle_jnet_1(gis_item=gis_item)
-    elif gis_item.jnet_type == "Jnet0":
-        logger.info("fixture type is a Jnet0", extra={"sn_nema": gis_item.sn_nema})
-        results = handle_jnet_0(gis_item=gis_item)
-    else:
-        logger.warning("fixture type is unknown", extra={"sn_nema": gis_item.sn_nema})
-        results = {
-            "LMS result": f"fixture {gis_item.sn_nema} is not a Jnet fixture",
-            "Status": "Failed",
-            "Message": "Item Failed to added to LMS OR Azure DB, for more details check the log or the result fields",
-        }
+def delete_lms_devices(serial_numbers: List[str]) -> dict:
+    def delete(serial_number: str) -> str:
+        try:
+            return lms_request.delete_device(group_id=LMS_DEVICES_GROUP_ID, serial_number=serial_number)
+        except Exception as e:
+            logger.error("fixture not been deleted", exc_info=True, extra={"old_sn": serial_number})
+            return f"Failed to delete fixture {serial_number} from LMS. Error: {e}"
 
-    logger.info("giscloud webhook workflow has finished", extra={"results": results})
-    monday_item.webhook_response = results
-    return monday_handler.add_item(
-        board_id=board_id,
-        group_id=group_id,
-        item=monday_item,
+    return dict(zip(serial_numbers, workflow_executor.map(with_request_context(delete), serial_numbers)))
+
+
+def handle_jnet_1_batch(indexed_items: List[Tuple[int, GisItem]], results: List[dict]):
+    devices = [
+        DeviceData(
+            pole=gis_item.sn_nema,
+            serial_number=gis_item.sn_nema,
+            latitude=gis_item.coordinate.lat,
+            longitude=gis_item.coordinate.long,
+            id_gateway=JNET_1_GATEWAY_ID,
+        )
+        for _, gis_item in indexed_items
+    ]
+    relay_groups = {
+        gis_item.sn_nema: LMS_GROUPS[gis_item.type_switches]
+        for _, gis_item in indexed_items
+        if gis_item.type_switches in LMS_GROUPS
+    }
+    with lms_request.site_session(LMS_SITE_NAME):
+        upserts = lms_request.upsert_devices(LMS_DEVICES_GROUP_ID, devices, relay_groups=relay_groups)
+        deletes = delete_lms_devices([gis_item.old_sn for _, gis_item in indexed_items if has_old_sn(gis_item)])
+
+    for index, gis_item in indexed_items:
+        upsert_result = upserts[gis_item.sn_nema]
+        results[index]["LMS result"] = upsert_result.to_json()
+        if has_old_sn(gis_item):
+            results[index]["delete old fixture"] = deletes[gis_item.old_sn]
+
+
+def handle_jnet_0_batch(indexed_items: List[Tuple[int, GisItem]], results: List[dict]):
+    gateway_ids = polygon_handler.get_gateway_ids(
+        lons=[gis_item.coordinate.long for _, gis_item in indexed_items],
+        lats=[gis_item.coordinate.lat for _, gis_item in indexed_items],
+    )
+    located_items, fixtures = [], []
+    for (index, gis_item), gateway_id in zip(indexed_items, gateway_ids):
+        if gateway_id is None:
+            logger.error("fixture rejected, no gateway found", extra={"sn_nema": gis_item.sn_nema})
+            results[index].update(no_gateway_result(gis_item))
+            continue
+        located_items.append((index, gis_item))
+        fixtures.append(
+            Fixture(
+                name=gis_item.sn_nema,
+                latitude=gis_item.coordinate.lat,
+                longitude=gis_item.coordinate.long,
+                id_gateway=JNET_0_GATEWAY_ID,
+                ident=gateway_id,
+            )
+        )
+    if not fixtures:
+        return
+    indexed_items = located_items
+    old_sns = [gis_item.old_sn for _, gis_item in indexed_items if has_old_sn(gis_item)]
+
+    db_conn = AzureDbConnection(conn_settings)
+    try:
+        upsert_result = db_conn.bulk_upsert_fixtures(fixtures, deleted_names=old_sns)
+        db_conn.conn.commit()
+    except Exception as e:
+        db_conn.conn.rollback()
+        logger.error("failed to write fixtures batch", exc_info=True, extra={"fixtures": len(fixtures)})
+        for index, gis_item in indexed_items:
+            results[index]["JSC result"] = f"Failed to insert fixture {gis_item.sn_nema} to DB: {e}"
+        return
+    finally:
+        db_conn.disconnect()
+
+    new_devices = [
+        DeviceData(
+            serial_number=fixture.name,
+            pole=fixture.name,
+            latitude=fixture.latitude,
+            longitude=fixture.longitude,
+            id_gateway=JNET_0_GATEWAY_ID,
+        )
+        for fixture in fixtures
+        if fixture.name in upsert_result.inserted
+    ]
+    upserts = lms_request.upsert_devices(LMS_DEVICES_GROUP_ID, new_devices)
+    deletes = delete_lms_devices(old_sns)
+
+    for (index, gis_item), fixture in zip(indexed_items, fixtures):
+        action = "inserted" if fixture.name in upsert_result.inserted else "updated"
+        results[index]["JSC result"] = f"{gis_item.sn_nema} {action} in JSC"
+        results[index]["fixture_info"] = fixture.to_dict()
+        if gis_item.sn_nema in upserts:
+            results[index]["LMS result"] = upserts[gis_item.sn_nema].to_json()
+        if has_old_sn(gis_item):
+            results[index]["delete old fixture"] = deletes[gis_item.old_sn]
+
+
+def upload_pictures(gis_items: List[GisItem], item_ids: List[Optional[str]]):
+    def upload(gis_item: GisItem, item_id: Optional[str]):
+        if item_id:
+            upload_picture_or_retry(gis_item, item_id, fetch_picture(gis_item))
+
+    list(workflow_executor.map(with_request_context(upload), gis_items, item_ids))
+
+
+def run_batch_workflow(gis_items: List[GisItem]) -> List[dict]:
+    results = [{"sn_nema": gis_item.sn_nema, "jnet_type": gis_item.jnet_type} for gis_item in gis_items]
+    # a serial sent twice in one batch would race itself in LMS, only its last feature is dispatched
+    last_indexes = {gis_item.sn_nema: index for index, gis_item in enumerate(gis_items)}
+    dispatched = []
+    for index, gis_item in enumerate(gis_items):
+        if last_indexes[gis_item.sn_nema] != index:
+            results[index]["Status"] = "Skipped"
+            results[index]["Message"] = f"superseded by feature {last_indexes[gis_item.sn_nema]} with the same sn_nema"
+        else:
+            dispatched.append((index, gis_item))
+    jnet_1_items = [(index, gis_item) for index, gis_item in dispatched if gis_item.jnet_type == "Jnet1"]
+    jnet_0_items = [(index, gis_item) for index, gis_item in dispatched if gis_item.jnet_type == "Jnet0"]
+    for index, gis_item in dispatched:
+        if gis_item.jnet_type not in ("Jnet0", "Jnet1"):
+            results[index]["LMS result"] = f"fixture {gis_item.sn_nema} is not a Jnet fixture"
+            results[index]["Status"] = "Failed"
+
+    logger.info(
+        "giscloud batch workflow started",
+        extra={
+            "features": len(gis_items),
+            "duplicates": len(gis_items) - len(dispatched),
+            "jnet_1": len(jnet_1_items),
+            "jnet_0": len(jnet_0_items),
+        },
+    )
+    jnet_1_future = (
+        workflow_executor.submit(with_request_context(handle_jnet_1_batch), jnet_1_items, results)
+        if jnet_1_items
+        else None
+    )
+    if jnet_0_items:
+        handle_jnet_0_batch(jnet_0_items, results)
+    if jnet_1_future is not None:
+        jnet_1_future.result()
+
+    monday_items = [
+        MondayItem(
+            sn_nema=gis_item.sn_nema,
+            insertion_date=gis_item.datetime,
+            coordinates=gis_item.coordinate,
+            picture=gis_item.picture,
+            notes=gis_item.note,
+            old_sn=gis_item.old_sn,
+            type_switch=gis_item.type_switches,
+            lamp_type=gis_item.lamp_type,
+            reason=gis_item.reason,
+            webhook_response=results[index],
+        )
+        for index, gis_item in dispatched
+    ]
+    item_results = monday_handler.add_items(
+        board_id=int(os.getenv("MONDAY_BOARD_ID")),
+        group_id=os.getenv("MONDAY_GROUP_ID"),
+        items=monday_items,
+    )
+    for (index, _), item_result in zip(dispatched, item_results):
+        results[index]["monday_item_id"] = item_result.item_id
+        if not item_result.ok:
+            results[index]["monday error"] = item_result.error
+    upload_pictures(
+        [gis_item for _, gis_item in dispatched],
+        [item_result.item_id for item_result in item_results],
+    )
+
+    logger.info("giscloud batch workflow has finished", extra={"features": len(gis_items)})
+    return results
+
+
+def idempotency_key(gis_item: GisItem) -> str:
+    return hash_key(
+        gis_item.feature_id,
+        gis_item.sn_nema,
+        gis_item.old_sn,
+        gis_item.datetime.isoformat(),
+        gis_item.coordinate.long,
+        gis_item.coordinate.lat,
     )
+
+
+def process_job(payload: dict):
+    return run_workflow(parse_gis_item(payload))
+
+
+def forget_failed_job(job: Job):
+    # the cached response of a queued delivery is its job id, once the job has failed for good a redelivery
+    # must enqueue a new job instead of being answered with the failed one
+    if job.idempotency_key:
+        get_idempotency_store().discard(job.idempotency_key)
+
+
+@lru_cache(maxsize=None)
+def get_job_workers() -> JobWorkerPool:
+    return JobWorkerPool(
+        get_job_queue(),
+        handler=process_job,
+        workers=int(os.getenv("GISCLOUD_WORKERS", "4")),
+        # GIS Cloud already got a 202 and never redelivers, a failed webhook has to be retried here
+        max_attempts=int(os.getenv("GISCLOUD_JOB_ATTEMPTS", "5")),
+        retry_delay=float(os.getenv("GISCLOUD_JOB_RETRY_DELAY", "60")),
+        on_failed=forget_failed_job,
+    )
+
+
+@lru_cache(maxsize=None)
+def get_picture_workers() -> JobWorkerPool:
+    return JobWorkerPool(
+        get_picture_queue(),
+        handler=process_picture_job,
+        workers=1,
+        max_attempts=int(os.getenv("MONDAY_PICTURE_ATTEMPTS", "5")),
+        retry_delay=float(os.getenv("MONDAY_PICTURE_RETRY_DELAY", "60")),
+        name="monday-picture-worker",
+    )
+
+
+@router.post("/giscloud")
+async def new_item(request: Request):
+    logger.info("new webhook request from giscloud")
+    traffic_capture.record(await request.json())
+    gis_item = await extract_gis_item(request)
+
+    key = idempotency_key(gis_item)
+    idempotency_store = get_idempotency_store()
+
+    if not async_mode_enabled():
+        return await run_in_threadpool(
+            with_request_context(idempotency_store.get_or_compute), key, lambda: run_workflow(gis_item)
+        )
+
+    request_body = await request.json()
+
+    def enqueue_job() -> dict:
+        job_id = get_job_queue().enqueue(request_body, idempotency_key=key)
+        get_job_workers().notify()
+        logger.info("giscloud webhook queued", extra={"job_id": job_id, "sn_nema": gis_item.sn_nema})
+        return {"job_id": job_id, "status": "queued"}
+
+    queued = await run_in_threadpool(with_request_context(idempotency_store.get_or_compute), key, enqueue_job)
+    return JSONResponse(status_code=202, content=queued)
+
+
+@router.get("/giscloud/jobs/{job_id}")
+async def get_job(job_id: str):
+    job = get_job_queue().get(job_id)
+    if job is None:
+        raise HTTPException(status_code=404, detail="Job not found")
+    return job
+
+
+@router.post("/giscloud/batch")
+async def new_items(request: Request):
+    request_body = await request.json()
+    features = request_body.get("features") if isinstance(request_body, dict) else request_body
+    if not isinstance(features, list):
+        raise HTTPException(
+            status_code=400,
+            detail="Invalid request body, expected a list of features",
+        )
+    logger.info("new batch webhook request from giscloud", extra={"features": len(features)})
+
+    results: List[Optional[dict]] = [None] * len(features)
+    valid_indexes, gis_items = [], []
+    for index, feature in enumerate(features):
+        try:
+            gis_items.append(parse_gis_item(feature))
+            valid_indexes.append(index)
+        except (HTTPException, KeyError, TypeError, ValueError) as e:
+            results[index] = {"Status": "Failed", "Message": f"Invalid feature: {e!r}"}
+
+    if gis_items:
+        for index, result in zip(
+            valid_indexes, await run_in_threadpool(with_request_context(run_batch_workflow), gis_items)
+        ):
+            results[index] = result
+    return results
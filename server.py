@@ -1,19 +1,38 @@
+import asyncio
 import os
 import pathlib
+import time
 
 import coloredlogs
 import snowmate_collector
 import uvicorn
 from dotenv import load_dotenv
-from fastapi import Depends, FastAPI
+from fastapi import Depends, FastAPI, Request
 from starlette.responses import RedirectResponse
 
-from dependencies import load_lms_token
-from routers import giscloud
-
-coloredlogs.install(
-    fmt="%(asctime)s.%(msecs)03d - %(levelname)-0s - %(filename)s - %(funcName)s - %(message)s",
+from dependencies import (
+    async_mode_enabled,
+    get_lms_request,
+    get_profiler,
+    load_lms_token,
 )
+from handlers import jsc_hanler, polygon_handler
+from handlers.metrics import finish_request_timings, start_request_timings
+from handlers.settings import conn_settings
+from handlers.structured_logging import StructuredLogging, parse_sample_rates
+from routers import admin, giscloud, metrics
+
+structured_logging = None
+if os.getenv("LOG_FORMAT", "").lower() == "json":
+    structured_logging = StructuredLogging(
+        buffer_size=int(os.getenv("LOG_BUFFER_SIZE", "10000")),
+        sample_rates=parse_sample_rates(os.getenv("LOG_SAMPLE_RATES")),
+    )
+    structured_logging.start()
+else:
+    coloredlogs.install(
+        fmt="%(asctime)s.%(msecs)03d - %(levelname)-0s - %(filename)s - %(funcName)s - %(message)s",
+    )
 
 app = FastAPI(
     dependencies=[Depends(load_lms_token)],
@@ -21,11 +40,49 @@ app = FastAPI(
 )
 
 app.include_router(giscloud.router)
+app.include_router(metrics.router)
+app.include_router(admin.router)
+
+
+@app.middleware("http")
+async def instrument_giscloud_requests(request: Request, call_next):
+    if not request.url.path.startswith("/giscloud"):
+        return await call_next(request)
+    profiler = get_profiler()
+    profiled = profiler.begin_request()
+    token = start_request_timings()
+    started_at = time.perf_counter()
+    try:
+        response = await call_next(request)
+    finally:
+        server_timing_header = finish_request_timings(token, time.perf_counter() - started_at)
+        if profiled is not None:
+            profiler.end_request(profiled)
+    response.headers["Server-Timing"] = server_timing_header
+    return response
 
 
 @app.on_event("startup")
 async def startup_event():
     load_dotenv()
+    asyncio.get_running_loop().run_in_executor(None, giscloud.warm_lms_inventory)
+    asyncio.get_running_loop().run_in_executor(None, polygon_handler.registry.load)
+    asyncio.get_running_loop().run_in_executor(None, jsc_hanler.warm_up, conn_settings)
+    giscloud.get_picture_workers().start()
+    if async_mode_enabled():
+        giscloud.get_job_workers().start()
+
+
+@app.on_event("shutdown")
+async def shutdown_event():
+    if giscloud.get_job_workers.cache_info().currsize:
+        await asyncio.get_running_loop().run_in_executor(None, giscloud.get_job_workers().stop)
+    if giscloud.get_picture_workers.cache_info().currsize:
+        await asyncio.get_running_loop().run_in_executor(None, giscloud.get_picture_workers().stop)
+    await asyncio.get_running_loop().run_in_executor(None, get_lms_request().close)
+    await asyncio.get_running_loop().run_in_executor(None, jsc_hanler.dispose_engines)
+    if structured_logging is not None:
+        structured_logging.stop()
 
 
 @app.get("/", include_in_schema=False)
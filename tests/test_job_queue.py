@@ -0,0 +1,65 @@
+import tempfile
+import time
+import unittest
+from pathlib import Path
+
+from handlers.job_queue import JobQueue, JobWorkerPool
+
+
+class JobWorkerPoolTest(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        self.queue = JobQueue(Path(self.directory.name) / "jobs.sqlite3")
+
+    def tearDown(self):
+        self.queue.close()
+        self.directory.cleanup()
+
+    def run_pool(self, handler, **kwargs) -> list:
+        failed = []
+        pool = JobWorkerPool(self.queue, handler, workers=1, poll_interval=0.01, on_failed=failed.append, **kwargs)
+        pool.start()
+        deadline = time.monotonic() + 5
+        while time.monotonic() < deadline and not (self.queue.counts().keys() <= {"done", "failed"}):
+            time.sleep(0.01)
+        pool.stop()
+        return failed
+
+    def test_failing_job_is_retried_until_max_attempts(self):
+        job_id = self.queue.enqueue({"n": 1}, idempotency_key="key")
+
+        def handler(payload):
+            raise RuntimeError("monday is down")
+
+        failed = self.run_pool(handler, max_attempts=3)
+        job = self.queue.get(job_id)
+        self.assertEqual(job["status"], "failed")
+        self.assertEqual(job["attempts"], 3)
+        self.assertEqual([job.idempotency_key for job in failed], ["key"])
+        self.assertEqual([job["id"] for job in self.queue.list_jobs("failed")], [job_id])
+
+    def test_retry_succeeds_after_a_failure(self):
+        job_id = self.queue.enqueue({"n": 1})
+        calls = []
+
+        def handler(payload):
+            calls.append(payload)
+            if len(calls) == 1:
+                raise RuntimeError("transient")
+            return "ok"
+
+        self.assertEqual(self.run_pool(handler, max_attempts=2), [])
+        self.assertEqual(self.queue.get(job_id)["status"], "done")
+
+    def test_failed_job_can_be_requeued(self):
+        job_id = self.queue.enqueue({"n": 1})
+        self.queue.claim()
+        self.queue.fail(job_id, "boom")
+        self.assertTrue(self.queue.retry(job_id))
+        self.assertFalse(self.queue.retry(job_id))
+        self.assertEqual(self.queue.get(job_id)["status"], "queued")
+        self.assertEqual(self.queue.counts(), {"queued": 1})
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,65 @@
+import unittest
+
+import requests
+
+from handlers.lms_requests import DeviceData, LMSRequest
+
+GROUP_ID = 1
+
+
+def http_error(status_code: int) -> requests.HTTPError:
+    response = requests.Response()
+    response.status_code = status_code
+    return requests.HTTPError(f"{status_code} error", response=response)
+
+
+class FakeLMSRequest(LMSRequest):
+    def __init__(self, update_error: Exception = None):
+        super().__init__("https://lms.test", token_manager=object())
+        self.update_error = update_error
+        self.calls = []
+
+    def update_device(self, group_id, serial_number, device_data):
+        self.calls.append("update")
+        if self.update_error is not None:
+            raise self.update_error
+        return device_data
+
+    def create_device(self, group_id, device_data):
+        self.calls.append("create")
+        self.inventory.add(group_id, device_data["serialNumber"])
+        return device_data
+
+
+def make_device(serial_number: str = "4020001") -> DeviceData:
+    return DeviceData(pole=serial_number, serial_number=serial_number, latitude=32.0, longitude=34.8, id_gateway=19)
+
+
+class UpsertDeviceTest(unittest.TestCase):
+    def test_known_device_is_updated(self):
+        lms_request = FakeLMSRequest()
+        lms_request.inventory.load(GROUP_ID, [{"serialNumber": "4020001"}])
+        result = lms_request.upsert_device(GROUP_ID, make_device())
+        self.assertTrue(result.ok)
+        self.assertEqual(result.action, "updated")
+        self.assertEqual(lms_request.calls, ["update"])
+
+    def test_stale_inventory_entry_falls_back_to_create(self):
+        lms_request = FakeLMSRequest(update_error=http_error(404))
+        lms_request.inventory.load(GROUP_ID, [{"serialNumber": "4020001"}])
+        result = lms_request.upsert_device(GROUP_ID, make_device())
+        self.assertTrue(result.ok)
+        self.assertEqual(result.action, "created")
+        self.assertEqual(lms_request.calls, ["update", "create"])
+        self.assertTrue(lms_request.inventory.contains(GROUP_ID, "4020001"))
+
+    def test_other_update_errors_are_reported(self):
+        lms_request = FakeLMSRequest(update_error=http_error(500))
+        lms_request.inventory.load(GROUP_ID, [{"serialNumber": "4020001"}])
+        result = lms_request.upsert_device(GROUP_ID, make_device())
+        self.assertFalse(result.ok)
+        self.assertEqual(lms_request.calls, ["update"])
+
+
+if __name__ == "__main__":
+    unittest.main()
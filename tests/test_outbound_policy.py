@@ -0,0 +1,113 @@
+import time
+import unittest
+
+import requests
+
+from handlers.outbound_policy import (
+    CircuitBreaker,
+    CircuitOpenError,
+    OutboundPolicy,
+    PolicySettings,
+    RetryPolicy,
+)
+
+RESET_TIMEOUT = 0.05
+
+
+class FakeSession:
+    def __init__(self, *outcomes):
+        self.outcomes = list(outcomes)
+        self.calls = 0
+
+    def request(self, method, url, **kwargs):
+        self.calls += 1
+        outcome = self.outcomes.pop(0)
+        if isinstance(outcome, BaseException):
+            raise outcome
+        response = requests.Response()
+        response.status_code = outcome
+        return response
+
+
+def make_policy() -> OutboundPolicy:
+    settings = PolicySettings(failure_threshold=1, reset_timeout=RESET_TIMEOUT, retry=RetryPolicy(attempts=1))
+    return OutboundPolicy("lms.test", settings)
+
+
+class CircuitBreakerTest(unittest.TestCase):
+    def test_opens_after_threshold(self):
+        breaker = CircuitBreaker(failure_threshold=2, reset_timeout=RESET_TIMEOUT)
+        breaker.record_failure()
+        self.assertEqual(breaker.state, "closed")
+        breaker.record_failure()
+        self.assertEqual(breaker.state, "open")
+        self.assertFalse(breaker.allow())
+
+    def test_half_open_allows_a_single_probe(self):
+        breaker = CircuitBreaker(failure_threshold=1, reset_timeout=RESET_TIMEOUT)
+        breaker.record_failure()
+        time.sleep(RESET_TIMEOUT)
+        self.assertEqual(breaker.state, "half_open")
+        self.assertTrue(breaker.allow())
+        self.assertFalse(breaker.allow())
+
+    def test_successful_probe_closes(self):
+        breaker = CircuitBreaker(failure_threshold=1, reset_timeout=RESET_TIMEOUT)
+        breaker.record_failure()
+        time.sleep(RESET_TIMEOUT)
+        self.assertTrue(breaker.allow())
+        breaker.record_success()
+        self.assertEqual(breaker.state, "closed")
+        self.assertTrue(breaker.allow())
+
+    def test_failed_probe_reopens(self):
+        breaker = CircuitBreaker(failure_threshold=3, reset_timeout=RESET_TIMEOUT)
+        for _ in range(3):
+            breaker.record_failure()
+        time.sleep(RESET_TIMEOUT)
+        self.assertTrue(breaker.allow())
+        breaker.record_failure()
+        self.assertEqual(breaker.state, "open")
+        time.sleep(RESET_TIMEOUT)
+        self.assertTrue(breaker.allow())
+
+
+class OutboundPolicyTest(unittest.TestCase):
+    def open_circuit(self, policy: OutboundPolicy):
+        with self.assertRaises(requests.ConnectionError):
+            policy.request(FakeSession(requests.ConnectionError()), "GET", "https://lms.test/")
+        self.assertEqual(policy.breaker.state, "open")
+        with self.assertRaises(CircuitOpenError):
+            policy.request(FakeSession(), "GET", "https://lms.test/")
+        time.sleep(RESET_TIMEOUT)
+
+    def test_probe_raising_other_request_errors_releases_the_probe(self):
+        policy = make_policy()
+        self.open_circuit(policy)
+        with self.assertRaises(requests.exceptions.ChunkedEncodingError):
+            policy.request(FakeSession(requests.exceptions.ChunkedEncodingError()), "GET", "https://lms.test/")
+        self.assertEqual(policy.breaker.state, "open")
+
+        time.sleep(RESET_TIMEOUT)
+        session = FakeSession(200)
+        self.assertEqual(policy.request(session, "GET", "https://lms.test/").status_code, 200)
+        self.assertEqual(policy.breaker.state, "closed")
+
+    def test_probe_raising_unexpected_errors_releases_the_probe(self):
+        policy = make_policy()
+        self.open_circuit(policy)
+        with self.assertRaises(ValueError):
+            policy.request(FakeSession(ValueError("boom")), "GET", "https://lms.test/")
+
+        time.sleep(RESET_TIMEOUT)
+        self.assertEqual(policy.request(FakeSession(200), "GET", "https://lms.test/").status_code, 200)
+        self.assertEqual(policy.breaker.state, "closed")
+
+    def test_server_errors_count_as_failures(self):
+        policy = make_policy()
+        self.assertEqual(policy.request(FakeSession(500), "GET", "https://lms.test/").status_code, 500)
+        self.assertEqual(policy.breaker.state, "open")
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,32 @@
+import logging
+import unittest
+
+from handlers.structured_logging import JsonFormatter, NonBlockingQueueHandler
+
+
+class NonBlockingQueueHandlerTest(unittest.TestCase):
+    def make_record(self, **extra) -> logging.LogRecord:
+        record = logging.LogRecord("giscloud", logging.INFO, __file__, 1, "fixture %s", ("4020001",), None)
+        record.__dict__.update(extra)
+        return record
+
+    def test_container_extras_are_copied(self):
+        request_body = {"data": {"sn_nema": "4020001"}}
+        serials = ["4020001"]
+        prepared = NonBlockingQueueHandler(None).prepare(self.make_record(request_body=request_body, serials=serials))
+        request_body["picture"] = "late"
+        serials.append("4020002")
+        self.assertEqual(prepared.request_body, {"data": {"sn_nema": "4020001"}})
+        self.assertEqual(prepared.serials, ["4020001"])
+        self.assertEqual(prepared.msg, "fixture 4020001")
+        self.assertIsNone(prepared.args)
+
+    def test_extras_are_not_serialized_on_the_calling_thread(self):
+        payload = object()
+        prepared = NonBlockingQueueHandler(None).prepare(self.make_record(payload=payload))
+        self.assertIs(prepared.payload, payload)
+        self.assertIn('"payload": "<object object', JsonFormatter().format(prepared))
+
+
+if __name__ == "__main__":
+    unittest.main()